@@ -1,22 +1,70 @@
 """Perform a periodic backup of data. Tested with Python 3.4"""
-import glob
 import os
 import posixpath
 import time
-import pickle
 import logging
+import fnmatch
+import heapq
+import itertools
+import tempfile
+import sys
 import threading
-from subprocess import Popen, PIPE
+import queue
 from pprint import pformat
-from collections import deque
 import osc
+import scan
+import metrics
+import fileindex
+import watcher
+import transport
 
 
 ##################
 #    Settings    #
 ##################
 PERIOD = 5  # seconds
-THREAD_LIMIT = 2  # limit concurrently copied files
+# use change notifications of the OS (if available) instead of waiting
+# PERIOD seconds, a full scan is still done every RECONCILE seconds
+WATCH = True
+RECONCILE = 60  # seconds
+# files are renamed and transferred once their size and modification time
+# have not changed for SETTLE seconds
+SETTLE = 10  # seconds
+THREAD_LIMIT = 2  # concurrently copied files at startup
+# The number of concurrent transfers is adapted every CONTROL_PERIOD seconds
+# between 1 and THREAD_MAX: raised by one while the throughput grows, halved
+# when it drops, a transfer fails or the mean transfer takes longer than
+# LATENCY_LIMIT (e.g. because the disk is busy with the acquisition).
+# Use None to keep THREAD_LIMIT.
+THREAD_MAX = 8
+CONTROL_PERIOD = 30  # seconds
+LATENCY_LIMIT = 120  # seconds
+# cap in bytes/s on the files started per second, or None
+BANDWIDTH = None
+# order of queued files: "smallest", "oldest" or None (as found)
+PRIORITY = "smallest"
+TIMEOUT = 600  # seconds a single transfer may take before it is killed
+RETRIES = 2  # attempts after a failed transfer
+BACKOFF = 5  # seconds before the first retry, doubled for every next one
+# if more than BUNDLE_MIN new files are found they are sent as one tar stream
+# and unpacked on the remote, use None to always copy file by file
+BUNDLE_MIN = 3
+# Run scanning, the settle check, transfers and recording as concurrent
+# stages (pipeline.py, needs Python 3.5), connected by queues of QUEUE_SIZE
+# files. The latency of every file is logged. Bundles are not used.
+PIPELINE = False
+QUEUE_SIZE = 1000
+# Compression while sending, chosen by the first matching file glob: "zlib",
+# "lzma", "zstd" (if the zstandard module is installed) or None. The remote
+# needs gzip, xz or zstd to decompress.
+COMPRESSION = [("*.csv", "zlib"), ("*", None)]
+# Large files matching these globs are sent in chunks of RESUME_CHUNK bytes
+# through a partial file on the remote. After a failure the transfer resumes
+# after the last chunk which arrived intact, and the whole file is verified
+# (with md5sum on the remote) before it is renamed. Their checksum in the
+# index is the md5 of the md5sum listing of their chunks.
+RESUMABLE = ["*.TIQ", "*.iqt"]
+RESUME_CHUNK = 8 << 20  # bytes
 # Remote host
 HOST = ""  # get your own
 # Remote folder
@@ -30,166 +78,524 @@ PATH_TO_DATA = os.path.join("D:\\", "temp", "data_transfer", "folder")
 #   cwd
 LOGFILE = "autocopy.log"
 LOGFILE = os.path.join(os.getcwd(), LOGFILE)
-# The list of files that have been copied already - uses pickle to prevent
-# having to parse the log file
+# The index (sqlite database) of files that have been copied already, with
+# their size, modification time and checksum
+FILE_INDEX = "file.index"
+FILE_INDEX = os.path.join(os.getcwd(), FILE_INDEX)
+# The pickled list of copied files written by earlier versions, imported
+# into FILE_INDEX when that is empty
 FILE_LIST = "file.list"
 FILE_LIST = os.path.join(os.getcwd(), FILE_LIST)
+# hashlib algorithm of the checksums recorded in FILE_INDEX, or None
+CHECKSUM = "md5"
+# Cached listing of the remote folder, only files changed since the newest
+# one in it are listed at startup (all of them if files were deleted)
+REMOTE_LIST = "remote.list"
+REMOTE_LIST = os.path.join(os.getcwd(), REMOTE_LIST)
 # Path to the putty scp client
 PSCP = "pscp"
+# How files are copied to the remote: "putty" (one pscp per file),
+# "putty-shared" (one shared plink connection), "openssh" (multiplexed ssh)
+# or "local" (REMOTE_FOLDER is a local folder)
+BACKEND = "putty"
 # The glob string used to search for files - I recommend this one for the oscilloscope,
 # for the S/A's you can use the basename, possibly with the file extension
 GLOBSTR = "*_2014*.csv"
-# logger, has to be defined here, but don't modify
+# Metrics are served in the Prometheus text format on localhost:METRICS_PORT
+# and written to the JSON file METRICS_SNAPSHOT every METRICS_PERIOD
+# seconds, use None to disable either
+METRICS_PORT = 9101
+METRICS_SNAPSHOT = None
+METRICS_PERIOD = 60  # seconds
+# logger and transport, have to be defined here, but don't modify
 logger = None
+remote = None
+pool = None
+cache = None
+verified = {}
 # leave this setting for spectrum analyzers, change to True for oscilloscope
 rename = False
 ##################
+SCAN_TIME = metrics.histogram("autocopy_scan_seconds",
+                              "Duration of a scan of the data folder")
+LOOP_TIME = metrics.histogram("autocopy_loop_seconds",
+                              "Duration of a loop, without waiting")
+SETTLE_TIME = metrics.histogram("autocopy_settle_seconds",
+                                "Time from finding a file until it settled")
+TRANSFER_TIME = metrics.histogram("autocopy_transfer_seconds",
+                                  "Duration of a file transfer with retries")
+TRANSFER_SIZE = metrics.histogram("autocopy_transfer_bytes",
+                                  "Size of the transferred files",
+                                  metrics.SIZE_BUCKETS)
+LATENCY = metrics.histogram("autocopy_latency_seconds",
+                            "Time from finding a file until it was recorded")
+TRANSFERRED = metrics.counter("autocopy_transferred_files_total",
+                              "Files transferred")
+TRANSFERRED_BYTES = metrics.counter("autocopy_transferred_bytes_total",
+                                    "Bytes transferred")
+FAILURES = metrics.counter("autocopy_failures_total",
+                           "Transfers failed after all retries")
+BACKLOG = metrics.gauge("autocopy_backlog_files",
+                        "Files found and not transferred yet")
+CONCURRENCY = metrics.gauge("autocopy_concurrency",
+                            "Limit of concurrent transfers")
 
 
-def check_access(fname, limit=30):
-    """Return True if last file modification was more than limit seconds ago."""
-    last_mod = os.stat(os.path.join(PATH_TO_DATA, fname)).st_mtime
-    now = time.time()
-    last = now - last_mod
-    if last > limit:
+def refresh():
+    """Scan the data folder."""
+    with SCAN_TIME.time():
+        cache.refresh()
+
+def check_access(fname):
+    """Return True if the file has not changed for SETTLE seconds."""
+    if cache.settled(fname):
+        SETTLE_TIME.observe(time.time() - cache.entries[fname].first_seen)
         return True
     else:
-        logger.info("'%s' excluded, last access %d s ago.", fname, last)
+        logger.info("'%s' excluded, unchanged for %d s.", fname,
+                    cache.unchanged_for(fname))
         return False
 
 def check_local():
-    """Return a set of all files (not directories) in the path dir."""
-    prev = os.getcwd()
-    os.chdir(PATH_TO_DATA)
+    """Return a set of all files (not directories) in the path dir, as found
+    by the last refresh of the cache."""
     # find all text files beginning with the current year
-    file_list = set(glob.glob("{base}".format(base=GLOBSTR)))
-    os.chdir(prev)
-    return file_list
-
-def check_remote():
-    """Return a set of files in remote directory."""
-    proc = Popen(["plink", "-ssh", HOST, "ls", REMOTE_FOLDER], shell=True,
-                 stdout=PIPE, stderr=PIPE)
-    out, err = proc.communicate()
-    if proc.poll() != 0:
-        logger.error("Error in ls: %s", err.decode('ascii').strip() if len(err)
-                                         else out.decode('ascii').strip())
-        import sys
+    return set(cache.names(GLOBSTR))
+
+def check_remote(listing):
+    """Update the cached listing of the remote directory."""
+    try:
+        listing.update()
+    except transport.TransportError as e:
+        logger.error("Error in ls: %s", e)
         print("Can't access remote location. Aborting")
         sys.exit(1)
-    return set(line.strip() for line in out.decode('ascii').splitlines())
+
+def compression_for(fname):
+    """Return the codec used to compress fname or None."""
+    for pattern, codec in COMPRESSION:
+        if fnmatch.fnmatch(fname, pattern):
+            return codec if codec in transport.CODECS else None
+    return None
+
+def resumable(fname):
+    """Return True if fname is transferred in verified chunks."""
+    return any(fnmatch.fnmatch(fname, pattern) for pattern in RESUMABLE)
 
 def copy_file(fname):
-    """Return Popen object that copies file from local DATA folder to REMOTE."""
+    """Copy file from local DATA folder to REMOTE.
+    Return the exit code and error output of the transfer."""
     src = os.path.join(PATH_TO_DATA, fname)
-    dest = posixpath.join(PATH_TO_REMOTE, fname)
-    return Popen([PSCP, src, dest], shell=True, stdout=PIPE, stderr=PIPE), fname
+    if resumable(fname):
+        outcome, err, checksum = remote.resume(src, fname, RESUME_CHUNK,
+                                               timeout=TIMEOUT)
+        if outcome == 0:
+            # recorded in the index by the main thread
+            verified[fname] = checksum
+        return outcome, err
+    codec = compression_for(fname)
+    if codec is None:
+        return remote.copy(src, fname, timeout=TIMEOUT)
+    outcome, err, stats = remote.send(src, fname, codec, timeout=TIMEOUT)
+    if stats is not None:
+        size, packed, cpu = stats
+        logger.info("Compressed '%s' with %s: %d -> %d bytes (ratio %.2f), "
+                    "%.3f s CPU", fname, codec, size, packed,
+                    size / max(packed, 1), cpu)
+    return outcome, err
+
+
+def count_differences(first, second, limit):
+    """Count the names found in only one of two sorted iterables, stopping
+    once limit is reached."""
+    first, second = iter(first), iter(second)
+    a, b = next(first, None), next(second, None)
+    count = 0
+    while count < limit and (a is not None or b is not None):
+        if b is None or (a is not None and a < b):
+            count += 1
+            a = next(first, None)
+        elif a is None or b < a:
+            count += 1
+            b = next(second, None)
+        else:
+            a, b = next(first, None), next(second, None)
+    return count
 
 
-class FileListBuilder:
-    """Handler for saving and loading the set of processed files."""
+class RemoteListing:
+    """Local copy of the listing of the remote folder. The file starts with
+    the newest modification time seen (the watermark), followed by the names
+    and modification times sorted by name."""
+    # changed files sorted in memory at once, larger updates are sorted in
+    # runs which are spilled to temporary files
+    chunk = 100000
+
     def __init__(self, name):
         self.filename = name
 
-    def save_list(self, set_obj, mode="a"):
-        """Save the list to file.
-        Mode should be: "a" or "w" to append or overwrite."""
-        with open(self.filename, mode + "b") as file_:
-            pickle.dump(set_obj, file_)
+    def watermark(self):
+        """Return the newest modification time in the listing or None."""
+        try:
+            with open(self.filename, encoding="utf-8") as file_:
+                return float(file_.readline().lstrip("#"))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    @staticmethod
+    def parse(lines):
+        """Yield tuples of name and modification time of listing lines."""
+        for line in lines:
+            name, _, mtime = line.rstrip("\n").rpartition("\t")
+            yield name, float(mtime)
+
+    def read(self):
+        """Yield tuples of name and modification time in name order."""
+        try:
+            with open(self.filename, encoding="utf-8") as file_:
+                # skip the watermark
+                file_.readline()
+                yield from self.parse(file_)
+        except FileNotFoundError:
+            return
+
+    def names(self):
+        """Yield the names in the listing in sorted order."""
+        return (name for name, _ in self.read())
+
+    def update(self):
+        """Fetch the files modified since the watermark and merge them into
+        the listing. Deleted files are not reported by that, so the listing
+        is fetched again as a whole if the number of files in it differs
+        from the remote folder."""
+        since = self.watermark()
+        total = self.fetch(since)
+        if since is not None:
+            files = remote.count_files()
+            if files != total:
+                logger.info("Remote folder has %d files, the listing %d, "
+                            "fetching all of it", files, total)
+                self.fetch(None)
 
-    def read_list(self):
-        """Read all data saved in file"""
-        read_set = set()
+    def fetch(self, since):
+        """Fetch the files modified since since (epoch, None fetches all)
+        and merge them into the listing, which is replaced if since is None.
+        The changed files are sorted in runs of at most chunk files, which
+        are written to temporary files and merged, so memory does not grow
+        with the number of changes. Return the number of files listed."""
+        newest = since or 0
+        count = total = 0
+        runs = []
         try:
-            with open(self.filename, "rb") as file_:
-                # unpickles until runs into EOFError
-                while True:
-                    read_set.update(pickle.load(file_))
-        except (FileNotFoundError, EOFError):
+            # one second of slack against the resolution of the timestamps
+            entries = remote.iter_listing(None if since is None
+                                          else since - 1)
+            while True:
+                run = sorted((name, mtime) for mtime, name in
+                             itertools.islice(entries, self.chunk))
+                if not run:
+                    break
+                count += len(run)
+                newest = max([newest] + [mtime for _, mtime in run])
+                runs.append(tempfile.TemporaryFile("w+", encoding="utf-8"))
+                runs[-1].writelines("%s\t%f\n" % entry for entry in run)
+                runs[-1].seek(0)
+            old = self.read() if since is not None else iter(())
+            # a changed file comes before its old entry, which is skipped
+            merged = heapq.merge(
+                *[((name, 1, mtime) for name, mtime in old)] +
+                [((name, 0, mtime) for name, mtime in self.parse(run))
+                 for run in runs])
+            temp = self.filename + ".tmp"
+            with open(temp, "w", encoding="utf-8") as file_:
+                file_.write("#%f\n" % newest)
+                last = None
+                for name, _, mtime in merged:
+                    if name != last:
+                        file_.write("%s\t%f\n" % (name, mtime))
+                        last = name
+                        total += 1
+        finally:
+            for run in runs:
+                run.close()
+        os.replace(temp, self.filename)
+        logger.info("Remote listing updated, %d new or changed files", count)
+        return total
+
+
+def get_processed(index, listing):
+    """Fill the index of processed files - chooses whether to use remote or
+    local."""
+    print("Getting list of processed files.")
+    check_remote(listing)
+    if not len(index) and index.migrate(FILE_LIST):
+        logger.info("Imported '%s' into '%s'", FILE_LIST, index.filename)
+    # if the index is empty take remote
+    if not len(index):
+        index.replace(listing.names())
+        logger.info("Local list empty, taking remote list")
+    # if local and remote differ by more than 5 entries, ask
+    elif count_differences(index.names(), listing.names(), 6) > 5:
+        choice = None
+        while choice not in ("l", "r"):
+            choice = input("Choose file list: l(ocal) or r(emote): ")
+        if choice == "r":
+            index.replace(listing.names())
+        logger.info("User chose list")
+    # if they don't, choose local, as the safer choice
+    else:
+        logger.info("Choosing local list")
+    return index
+
+
+def describe(fname):
+    """Return the size, mtime and checksum of a transferred file for the
+    index, or Nones if it can't be read."""
+    path = os.path.join(PATH_TO_DATA, fname)
+    try:
+        stat = os.stat(path)
+        if fname in verified:
+            digest = verified.pop(fname)
+        else:
+            digest = fileindex.checksum(path, CHECKSUM) if CHECKSUM else None
+    except OSError as e:
+        logger.error("Can't read '%s' for the index: %s", fname, e)
+        return None, None, None
+    return stat.st_size, stat.st_mtime, digest
+
+def record(index, fname):
+    """Add a transferred file to the index of processed files."""
+    index.add(fname, *describe(fname))
+
+
+def count_transfer(size):
+    """Account for a transferred file in the metrics."""
+    TRANSFERRED.inc()
+    TRANSFERRED_BYTES.inc(size)
+    TRANSFER_SIZE.observe(size)
+
+def file_stat(fname):
+    """Return the size and mtime of a local file, as found by the last scan
+    if possible, or zeros if it can't be read."""
+    entry = cache.entries.get(fname) if cache is not None else None
+    if entry is not None:
+        return entry.size, entry.mtime
+    try:
+        stat = os.stat(os.path.join(PATH_TO_DATA, fname))
+    except OSError:
+        return 0, 0
+    return stat.st_size, stat.st_mtime
+
+
+class Throttle:
+    """Token bucket pacing the start of transfers to rate bytes per second
+    on average. A file larger than the allowance puts the bucket in debt,
+    which the next transfers wait for."""
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self, size):
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance +
+                                 (now - self.last) * self.rate) - size
+            self.last = now
+            delay = max(0, -self.allowance / self.rate)
+        time.sleep(delay)
+
+
+class Controller:
+    """Additive increase, multiplicative decrease of the number of concurrent
+    transfers, based on the throughput and mean duration of the transfers
+    finished in every period."""
+    def __init__(self, limit, maximum, period=CONTROL_PERIOD,
+                 latency=LATENCY_LIMIT):
+        self.limit = limit
+        self.maximum = maximum
+        self.period = period
+        self.latency = latency
+        self.rate = 0
+        self.lock = threading.Lock()
+        self.reset(time.time())
+        CONCURRENCY.set(limit)
+
+    def reset(self, now):
+        self.start = now
+        self.bytes = 0
+        self.durations = []
+        self.failures = 0
+        # whether files were waiting for a free slot
+        self.saturated = False
+
+    def record(self, size, duration, ok):
+        """Account for a finished transfer, adjusting the limit at the end of
+        a period."""
+        with self.lock:
+            self.bytes += size if ok else 0
+            self.durations.append(duration)
+            self.failures += not ok
+            now = time.time()
+            if now - self.start >= self.period:
+                self.adjust(now)
+
+    def adjust(self, now):
+        rate = self.bytes / (now - self.start)
+        latency = sum(self.durations) / len(self.durations)
+        old = self.limit
+        if self.maximum is None:
+            # fixed, only reporting
             pass
-        return read_set
-
-    def get_processed(self):
-        """Get processed list - chooses whether to use remote or local."""
-        print("Getting list of processed files.")
-        remote_list = check_remote()
-        local_list = self.read_list()
-        # if local_list is empty take remote
-        if not local_list:    
-            self.save_list(remote_list, "w")
-            logger.info("Local list empty, taking remote list")
-            processed = remote_list
-        # if local_list is not empty, compare to remote
+        elif self.failures or latency > self.latency or \
+                rate < 0.9 * self.rate:
+            self.limit = max(1, self.limit // 2)
+        elif self.saturated and rate >= self.rate:
+            self.limit = min(self.maximum, self.limit + 1)
+        logger.info("Concurrency %d -> %d: %.2f MB/s, mean transfer %.1f s, "
+                    "%d failed", old, self.limit, rate / 1e6, latency,
+                    self.failures)
+        if self.limit < old:
+            # the next period runs with fewer slots, don't compare to it
+            self.rate = 0
+        elif self.saturated:
+            # only compare periods in which the slots were used
+            self.rate = rate
+        CONCURRENCY.set(self.limit)
+        self.reset(now)
+
+
+class TransferPool:
+    """Persistent worker threads copying files taken from a shared queue, so
+    a free worker starts on the next file as soon as its transfer is done.
+    With a maximum the number of concurrent transfers is adapted by a
+    :py:class:`Controller`, queued files are taken in the order of priority
+    and their start is paced to bandwidth bytes/s."""
+    def __init__(self, workers=THREAD_LIMIT, copy=None, retries=RETRIES,
+                 backoff=BACKOFF, maximum=None, bandwidth=None,
+                 priority=None):
+        self.copy = copy_file if copy is None else copy
+        self.retries = retries
+        self.backoff = backoff
+        self.controller = Controller(workers, maximum and max(workers,
+                                                              maximum))
+        self.throttle = Throttle(bandwidth) if bandwidth else None
+        self.priority = priority
+        self.tasks = queue.PriorityQueue()
+        self.count = 0
+        self.active = 0
+        self.slots = threading.Condition()
+        for _ in range(self.controller.maximum or workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+
+    def work(self):
+        while True:
+            with self.slots:
+                while self.active >= self.controller.limit:
+                    self.slots.wait()
+                self.active += 1
+            _, _, fname, results = self.tasks.get()
+            if not self.tasks.empty():
+                self.controller.saturated = True
+            results.put((fname, self.run(fname)))
+            with self.slots:
+                self.active -= 1
+                self.slots.notify_all()
+
+    def run(self, fname):
+        """Transfer a file, accounting for it in the controller. Return True
+        on success."""
+        size = file_stat(fname)[0]
+        start = time.time()
+        ok = self.handle(fname, size)
+        duration = time.time() - start
+        self.controller.record(size, duration, ok)
+        TRANSFER_TIME.observe(duration)
+        if ok:
+            count_transfer(size)
         else:
-            # if local and remote differ by more than 5 entries, ask
-            if len(local_list ^ remote_list) > 5:
-                choices = {'l':local_list, "r":remote_list}
-                choice = None
-                while choice is None:
-                    choice = input("Choose file list: l(ocal) or r(emote): ")
-                    choice = choices.get(choice, None)
-                self.save_list(choice, "w")
-                logger.info("User chose list")
-                processed = choice
-            # if they don't, choose local, as the safer choice
-            else:
-                self.save_list(local_list, "w")
-                logger.info("Choosing local list")
-                processed = local_list
-        return processed
-
-
-def handle_process(in_tup, deq):
-    """Append the filename to deque if copying it ends with a 0 output code."""
-    proc, fname = in_tup
-    outcome = proc.poll()
-    if outcome is None:
-        outcome = proc.wait()
+            FAILURES.inc()
+        return ok
+
+    def handle(self, fname, size=0):
+        """Copy a file, retrying after failures. Return True on success."""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            if self.throttle is not None:
+                self.throttle.wait(size)
+            outcome, err = self.copy(fname)
+            if outcome == 0:
+                logger.info("Transferred file: '%s'", fname)
+                return True
+            logger.error("Error in file '%s', code %d (attempt %d of %d)",
+                         fname, outcome, attempt + 1, self.retries + 1)
+            logger.error("Error output: %s", err)
+        return False
+
+    def key(self, fname):
+        """Return the sort key of a file in the queue."""
+        if self.priority == "smallest":
+            return file_stat(fname)[0]
+        elif self.priority == "oldest":
+            return file_stat(fname)[1]
+        return 0
+
+    def transfer(self, files):
+        """Queue files for transfer and yield tuples of the file name and
+        success as the transfers finish."""
+        results = queue.Queue()
+        count = 0
+        for fname in files:
+            # the counter keeps equal keys in the order they were queued
+            self.count += 1
+            self.tasks.put((self.key(fname), self.count, fname, results))
+            count += 1
+        for _ in range(count):
+            yield results.get()
+
+def get_pool():
+    """Return the transfer pool, starting it on first use."""
+    global pool
+    if pool is None:
+        pool = TransferPool(THREAD_LIMIT, maximum=THREAD_MAX,
+                            bandwidth=BANDWIDTH, priority=PRIORITY)
+    return pool
+
+def transfer_stream(files):
+    """Transfer files, yielding (fname, success) as transfers finish."""
+    return get_pool().transfer(files)
+
+def transfer_bundle(files):
+    """Transfer files as one archive, yielding (fname, success) for each file.
+    Falls back to copying the files one by one if that fails. Resumable files
+    are always sent on their own."""
+    large = set(filter(resumable, files))
+    files = sorted(set(files).difference(large))
+    srcs = [(os.path.join(PATH_TO_DATA, fname), fname) for fname in files]
+    # compress the bundle if all files share a codec
+    codecs = set(compression_for(fname) for fname in files)
+    codec = codecs.pop() if len(codecs) == 1 else None
+    outcome, err = remote.bundle(srcs, timeout=TIMEOUT, codec=codec) \
+        if files else (0, "")
     if outcome == 0:
-        logger.info("Transferred file: '%s'", fname)
-        deq.append(fname)
+        if files:
+            logger.info("Transferred bundle of %d files", len(files))
+        for fname in files:
+            count_transfer(file_stat(fname)[0])
+            yield fname, True
     else:
-        logger.error("Error in file '%s', code %d", fname, outcome)
-        logger.error("Error output: %s",
-                      proc.stderr.read().decode("ascii").strip())
+        logger.error("Error in bundle of %d files, code %d", len(files),
+                     outcome)
+        logger.error("Error output: %s", err)
+        large.update(files)
+    yield from transfer_stream(large)
 
 def transfer_files(files):
     """Transfer files and return list of successfully transf. ones."""
-    # for each new file start copying (asynchronously)
-    # creates a generator object that be used to late start the copying
-    processes = (copy_file(file_) for file_ in files)
-    # deque for gathering data from threads
-    deq = deque()
-    
-    # threaded version
-    threads = []
-    def join_threads():
-        # access to threads
-        nonlocal threads
-        # join all threads
-        for thread in threads:
-            thread.join()
-        # clear list
-        threads = []
-    # wait for end of transfer
-    for i, proc in enumerate(processes):
-        if i % THREAD_LIMIT == 0:
-            # join started threads before spawning new ones
-            join_threads()
-        thread = threading.Thread(target=handle_process,
-                                  args=(proc, deq))
-        thread.start()
-        threads.append(thread)
-    else:
-        # will execute as the last statement
-        join_threads()
-
-    # serial version:
-    # process = [proc for proc in processes]
-    # for proc in processes:
-    #     handle_process(proc, dq)
-    transferred = set(deq)
-    return transferred
+    return set(fname for fname, ok in transfer_stream(files) if ok)
 
 def timing(func):
     """Decorator: prints function execution time."""
@@ -201,37 +607,77 @@ def timing(func):
         return result
     return deco_func
 
-@timing
-def loop(processed, flb):
-    """Main application loop."""
-    if rename:
-        # rename all files that have the default filenames
-        osc.rename_all(PATH_TO_DATA)
+def poll_files(processed):
+    """Return the set of new local files which are old enough to transfer."""
     # get locally available files minus the transferred ones
-    files = check_local().difference(processed)
+    files = processed.missing(check_local())
     if files:
         logger.info("Found new files:\n%s",pformat(files, indent=20,
                                                     compact=True     ))
         # get rid of files that are too new
         files = set(filter(check_access, files))
-        # transfer files
-        transferred = transfer_files(files)
-        # update processed list
-        processed.update(transferred)
-        # pickle (append) set of transferred files
-        flb.save_list(transferred)
-    time.sleep(PERIOD)
+    return files
+
+@timing
+def loop(processed, watch=None):
+    """Main application loop."""
+    began = time.time()
+    poll = watch is None or watch.reconcile_due()
+    if rename or poll:
+        # one scan of the data folder per tick
+        refresh()
+    if rename:
+        # rename all files that have the default filenames
+        osc.rename_all(PATH_TO_DATA, cache)
+    files = poll_files(processed) if poll else set()
+    if watch is not None:
+        # closed files are complete, no need to check their access time
+        waited = time.time()
+        closed = processed.missing(watch.wait(PERIOD))
+        began += time.time() - waited
+        if closed:
+            logger.info("Closed new files:\n%s",pformat(closed, indent=20,
+                                                         compact=True     ))
+        files.update(closed)
+    # transfer files, recording each one as soon as it is done
+    BACKLOG.set(len(files))
+    if BUNDLE_MIN is not None and len(files) > BUNDLE_MIN:
+        results = transfer_bundle(files)
+    else:
+        results = transfer_stream(files)
+    for fname, ok in results:
+        if ok:
+            # update processed index
+            record(processed, fname)
+            BACKLOG.set(BACKLOG.value - 1)
+    LOOP_TIME.observe(time.time() - began)
+    if watch is None:
+        time.sleep(PERIOD)
 
 def main():
+    global remote, cache
+    metrics.start(METRICS_PORT, METRICS_SNAPSHOT, METRICS_PERIOD)
+    cache = scan.FileCache(PATH_TO_DATA, SETTLE)
+    remote = transport.make_transport(BACKEND, HOST, REMOTE_FOLDER)
+    if BACKEND.startswith("putty"):
+        remote.pscp = PSCP
     logger.info("In directory: %s", os.getcwd())
     logger.info("Backing up directory: %s", PATH_TO_DATA)
     logger.info("Remote save location: %s", PATH_TO_REMOTE)
-    flb = FileListBuilder(FILE_LIST)
-    processed = flb.get_processed()
+    processed = get_processed(fileindex.FileIndex(FILE_INDEX),
+                              RemoteListing(REMOTE_LIST))
     print("Got list of processed files.")
+    watch = None
+    if WATCH:
+        watch = watcher.make_watcher(PATH_TO_DATA, GLOBSTR, RECONCILE)
+    if PIPELINE:
+        import pipeline
+        pipeline.Pipeline(sys.modules[__name__], processed, watch,
+                          QUEUE_SIZE).run()
+        return
     while True:
         # run program loop
-        loop(processed, flb)
+        loop(processed, watch)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,149 @@
+"""Generator of synthetic beamtime data: LeCroy traces of the four channels
+(injection and extraction), RSA51/RSA52 TIQ and RSA30 iqt files, with the
+names and headers of the real instruments, for benchmarking without them.
+Works with Python 2 and 3. Run with:
+
+    python beamtime.py DIRECTORY [shots] [--raw] [--flat]
+"""
+import os, sys, time, random
+
+START = 1393671600  # 2014-03-01 12:00:00 local time
+CYCLE = 60  # seconds between injections
+EXT_DELAY = 20  # seconds from injection to extraction
+RSA50_DELAY = 5  # seconds from injection to the TIQ files
+RSA30_DELAY = 6  # seconds from injection to the iqt file
+SAMPLES = 1000  # samples per trace
+WINDOW = 10e-6  # seconds covered by a trace
+# pulse widths in seconds, osc.LIMIT (1 us) separates them
+WIDTHS = {"inj": 0.2e-6, "ext": 3e-6}
+TIQ_SIZE = 64 << 10  # bytes
+IQT_SIZE = 16 << 10  # bytes
+CHANNELS = ("C1", "C2", "C3", "C4")
+OSC_TIME = "%Y.%m.%d.%H.%M.%S"
+RSA30_TIME = "%Y%m%d-%H%M%S"
+TRACE_TIME = "%d-%b-%Y %H:%M:%S"
+
+HEADER = ("LECROYWR64Xi,12345,Waveform\n"
+          "Segments,1,SegmentSize,{samples}\n"
+          "Segment,TrigTime,TimeSinceSegment1\n"
+          "#1,{stamp},0\n"
+          "Time,Ampl\n")
+
+
+def render_samples(samples, width, delta_t=1e-9, seed=0):
+    """Return the sample lines of a trace with a rectangular pulse of width
+    seconds on top of noise."""
+    rand = random.Random(seed)
+    start = samples // 4
+    stop = start + int(width / delta_t)
+    return "".join("{:.6e},{:.6e}\n".format(
+        i*delta_t - 1e-6, (0.5 if start <= i < stop else 0.0) +
+        rand.gauss(0, 0.01)) for i in range(samples))
+
+
+def write_trace(path, samples, width, delta_t=1e-9, stamp=None, seed=0):
+    """Write a LeCroy CSV trace with a rectangular pulse of width seconds on
+    top of noise."""
+    if stamp is None:
+        stamp = time.strftime(TRACE_TIME)
+    with open(path, "w") as file_:
+        file_.write(HEADER.format(samples=samples, stamp=stamp))
+        file_.write(render_samples(samples, width, delta_t, seed))
+
+
+class Beamtime(object):
+    """Writes the files of consecutive shots below root. The sample lines and
+    binary contents are rendered once and reused, so that large trees are
+    written at the speed of the disk.
+
+    With tree (the default) the files go to Oscil/C1..C4, RSA51, RSA52 and
+    RSA30 as merger expects them, with flat all go to root as on the
+    acquisition PCs. With raw the traces are named as the oscilloscope saves
+    them (C1Trace00000.csv), before osc renames them."""
+    def __init__(self, root, start=START, cycle=CYCLE, samples=SAMPLES,
+                 tiq_size=TIQ_SIZE, iqt_size=IQT_SIZE, raw=False, flat=False):
+        self.root = root
+        self.start = start
+        self.cycle = cycle
+        self.samples = samples
+        self.raw = raw
+        self.flat = flat
+        delta_t = WINDOW / samples
+        self.bodies = dict((kind, render_samples(samples, width, delta_t))
+                           for kind, width in WIDTHS.items())
+        block = bytearray(random.Random(1).getrandbits(8)
+                          for _ in range(4096))
+        self.tiq = bytes(block * (tiq_size // 4096 + 1))[:tiq_size]
+        self.iqt = bytes(block * (iqt_size // 4096 + 1))[:iqt_size]
+        self.traces = 0
+        for folder in self.folders():
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+    def folder(self, name):
+        """Return the folder of an instrument or channel."""
+        if self.flat:
+            return self.root
+        if name in CHANNELS:
+            return os.path.join(self.root, "Oscil", name)
+        return os.path.join(self.root, name)
+
+    def folders(self):
+        return set(self.folder(name) for name in
+                   CHANNELS + ("RSA51", "RSA52", "RSA30"))
+
+    def write(self, path, data, moment):
+        mode = "wb" if isinstance(data, bytes) else "w"
+        with open(path, mode) as file_:
+            file_.write(data)
+        os.utime(path, (moment, moment))
+        return path
+
+    def trace(self, channel, kind, moment):
+        stamp = time.localtime(moment)
+        if self.raw:
+            name = "%sTrace%05d.csv" % (channel, self.traces)
+        else:
+            name = "%s_%s_%s.csv" % (channel, time.strftime(OSC_TIME, stamp),
+                                     kind)
+        text = HEADER.format(samples=self.samples,
+                             stamp=time.strftime(TRACE_TIME, stamp))
+        return self.write(os.path.join(self.folder(channel), name),
+                          text + self.bodies[kind], moment)
+
+    def shot(self, number):
+        """Write the 11 files of shot number and return their paths."""
+        moment = self.start + number * self.cycle
+        paths = []
+        for kind, delay in (("inj", 0), ("ext", EXT_DELAY)):
+            for channel in CHANNELS:
+                paths.append(self.trace(channel, kind, moment + delay))
+            self.traces += 1
+        stamp = time.localtime(moment + RSA50_DELAY)
+        for rsa in ("RSA51", "RSA52"):
+            name = "%s-%s.%06d.TIQ" % (rsa, time.strftime(OSC_TIME, stamp),
+                                       number % 1000000)
+            paths.append(self.write(os.path.join(self.folder(rsa), name),
+                                    self.tiq, moment + RSA50_DELAY))
+        stamp = time.localtime(moment + RSA30_DELAY)
+        name = "%s-%04d.iqt" % (time.strftime(RSA30_TIME, stamp),
+                                number % 10000)
+        paths.append(self.write(os.path.join(self.folder("RSA30"), name),
+                                self.iqt, moment + RSA30_DELAY))
+        return paths
+
+    def shots(self, count, first=0):
+        """Write count shots and return the number of files written."""
+        return sum(len(self.shot(number))
+                   for number in range(first, first + count))
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not args:
+        sys.exit(__doc__)
+    beamtime = Beamtime(args[0], raw="--raw" in sys.argv,
+                        flat="--flat" in sys.argv)
+    start = time.time()
+    count = beamtime.shots(int(args[1]) if len(args) > 1 else 100)
+    print("Wrote %d files in %.1f s" % (count, time.time() - start))
@@ -0,0 +1,75 @@
+"""Benchmarks for autocopy using a fake transport which sleeps instead of
+copying. Run with:
+
+    python bench_autocopy.py [number of files]
+"""
+import sys, time, random, logging, threading
+import autocopy
+
+
+class FakeTransport:
+    """Transport taking a random time per file, with a few slow files."""
+    def __init__(self, mean=0.02, slow=0.5, slow_fraction=0.05, seed=1):
+        self.random = random.Random(seed)
+        self.latency = {}
+        self.mean = mean
+        self.slow = slow
+        self.slow_fraction = slow_fraction
+
+    def delay(self, name):
+        if name not in self.latency:
+            if self.random.random() < self.slow_fraction:
+                self.latency[name] = self.slow
+            else:
+                self.latency[name] = self.random.expovariate(1 / self.mean)
+        return self.latency[name]
+
+    def copy(self, src, name, timeout=None):
+        time.sleep(self.delay(name))
+        return 0, ""
+
+    def listdir(self):
+        return []
+
+    def close(self):
+        pass
+
+
+def batch_join(files, copy, limit):
+    """The previous scheme: start limit transfers and wait for all of them
+    before starting the next group."""
+    for i in range(0, len(files), limit):
+        threads = [threading.Thread(target=copy, args=(fname,))
+                   for fname in files[i:i+limit]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def bench_transfer(count):
+    """Compare the batch-join scheme to the TransferPool."""
+    files = ["C1_2014.03.01.12.00.%06d_inj.csv" % i for i in range(count)]
+    fake = FakeTransport()
+    for fname in files:
+        fake.delay(fname)
+    copy = lambda fname: fake.copy(fname, fname)
+    print("%d files, %.1f s of transfers in total" %
+          (count, sum(fake.latency.values())))
+    print("%8s%12s%12s%12s" % ("workers", "batch-join", "pool", "files/s"))
+    for limit in (1, 2, 4, 8):
+        start = time.time()
+        batch_join(files, copy, limit)
+        batch = time.time() - start
+        pool = autocopy.TransferPool(limit, copy, retries=0)
+        start = time.time()
+        done = sum(1 for _, ok in pool.transfer(files) if ok)
+        streamed = time.time() - start
+        assert done == count
+        print("%8d%11.2fs%11.2fs%12.1f" % (limit, batch, streamed,
+                                             count / streamed))
+
+
+if __name__ == "__main__":
+    autocopy.logger = logging.getLogger("autocopy")
+    bench_transfer(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,150 @@
+"""Benchmarks of the daemons on synthetic beamtimes written by beamtime.py.
+With Python 2 the merger is timed: the discovery of the files (first and
+incremental catalog update), assembling the injections and merging them
+with a stub time2root, after checking that an injection is assembled when
+its files arrive out of order. With Python 3 renaming (which classifies the traces) and a
+loop of autocopy to a local folder are timed. Run with:
+
+    python bench_beamtime.py [files ...]
+"""
+import os, sys, time, shutil, logging, tempfile
+import beamtime
+
+FILES_PER_SHOT = 11
+# renaming and transferring parse and copy every file, so they are run on at
+# most this many files
+COPY_LIMIT = 100000
+# injections merged by the stub time2root
+MERGE_LIMIT = 100
+
+
+def timed(func, *args):
+    """Return the result of func and the seconds it took."""
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+
+def stub_t2r(folder):
+    """Write a time2root stand-in which only exits and return its path."""
+    path = os.path.join(folder, "time2root")
+    with open(path, "w") as file_:
+        file_.write("#!/bin/sh\nexit 0\n")
+    os.chmod(path, 0o755)
+    return path
+
+
+def use_tree(merger, root):
+    """Point the settings and catalogs of merger to a beamtime at root."""
+    for name in ("ROOT", "Merger"):
+        if not os.path.isdir(os.path.join(root, name)):
+            os.makedirs(os.path.join(root, name))
+    merger.OUTPUT_DIR = os.path.join(root, "ROOT")
+    merger.CONTENT = os.path.join(root, "Merger", "content.list")
+    merger.PROCESS = os.path.join(root, "Merger", "processed.journal")
+    merger.T2R = stub_t2r(root)
+    for name, catalog in list(merger.CATALOGS.items()):
+        folder = os.path.join(root, "Oscil", name) \
+            if name in merger.OSC_CHANS else os.path.join(root, name)
+        merger.CATALOGS[name] = merger.FileCatalog(
+            folder, catalog.pattern, catalog.extractor)
+    merger.ASSEMBLER = merger.InjectionAssembler()
+
+
+def check_arrival_order(merger):
+    """Check that a shot whose spectrum analyzer files arrive a loop before
+    its scope traces is ready as soon as all its files are there."""
+    root = tempfile.mkdtemp()
+    try:
+        beam = beamtime.Beamtime(root, start=int(time.time()) - 30)
+        use_tree(merger, root)
+        assembler = merger.ASSEMBLER
+        beam.shot(0)
+        ready = assembler.update(merger.update_catalogs(), set())
+        assert [start for start, _, files in ready if files] == [beam.start]
+        assembler.close(beam.start)
+        traces = [path for path in beam.shot(1) if path.endswith(".csv")]
+        for path in traces:
+            os.rename(path, path + ".hidden")
+        assert not assembler.update(merger.update_catalogs(), set())
+        for path in traces:
+            os.rename(path + ".hidden", path)
+        ready = assembler.update(merger.update_catalogs(), set())
+        assert [(start, len(files)) for start, _, files in ready] == \
+            [(beam.start + beam.cycle, FILES_PER_SHOT)], ready
+    finally:
+        shutil.rmtree(root)
+
+
+def bench_merger(sizes):
+    import merger
+    check_arrival_order(merger)
+    print("{:>9s}{:>11s}{:>11s}{:>11s}{:>11s}{:>11s}{:>13s}".format(
+        "files", "generate", "scan", "rescan", "assemble", "merge",
+        "inj/min"))
+    for files in sizes:
+        root = tempfile.mkdtemp()
+        try:
+            shots = max(files // FILES_PER_SHOT, 3)
+            _, generate = timed(beamtime.Beamtime(root).shots, shots)
+            use_tree(merger, root)
+            added, scan = timed(merger.update_catalogs)
+            _, rescan = timed(merger.update_catalogs)
+            ready, find = timed(merger.ASSEMBLER.update, added, set())
+            # merging runs t2r for every injection, time the newest ones
+            jobs = [(start, data, True)
+                    for start, _, data in ready[-MERGE_LIMIT:]]
+            merged = len(jobs)
+            _, merge = timed(lambda: [merger.merge_job(job) for job in jobs])
+            print("{:>9d}{:>10.2f}s{:>10.2f}s{:>10.3f}s{:>10.3f}s{:>10.2f}s"
+                  "{:>13.1f}".format(shots * FILES_PER_SHOT, generate, scan,
+                                     rescan, find, merge,
+                                     merged * 60. / max(merge, 1e-3)))
+        finally:
+            shutil.rmtree(root)
+
+
+def bench_autocopy(sizes):
+    import autocopy, scan, transport, fileindex, osc
+    autocopy.logger = logging.getLogger("autocopy")
+    autocopy.GLOBSTR = "*"
+    autocopy.SETTLE = 0
+    autocopy.PERIOD = 0
+    autocopy.BUNDLE_MIN = None
+    print("{:>9s}{:>11s}{:>11s}{:>11s}{:>11s}{:>11s}".format(
+        "files", "generate", "scan", "rename", "transfer", "files/s"))
+    for files in sizes:
+        root = tempfile.mkdtemp()
+        try:
+            shots = max(min(files, COPY_LIMIT) // FILES_PER_SHOT, 1)
+            data = os.path.join(root, "data")
+            remote = os.path.join(root, "remote")
+            os.makedirs(remote)
+            _, generate = timed(beamtime.Beamtime(data, raw=True,
+                                                  flat=True).shots, shots)
+            cache = scan.FileCache(data, 0)
+            # files are settled once a second scan finds them unchanged
+            cache.refresh()
+            _, refresh = timed(cache.refresh)
+            _, rename = timed(osc.rename_all, data, cache)
+            autocopy.PATH_TO_DATA = data
+            autocopy.cache = cache
+            autocopy.remote = transport.LocalTransport("", remote)
+            index = fileindex.FileIndex(os.path.join(root, "file.index"))
+            cache.refresh()
+            _, transfer = timed(autocopy.loop, index)
+            assert len(os.listdir(remote)) == shots * FILES_PER_SHOT
+            index.close()
+            print("{:>9d}{:>10.2f}s{:>10.3f}s{:>10.2f}s{:>10.2f}s{:>11.1f}"
+                  .format(shots * FILES_PER_SHOT, generate, refresh, rename,
+                          transfer, shots * FILES_PER_SHOT / transfer))
+        finally:
+            shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    if sys.version_info[0] < 3:
+        bench_merger(sizes)
+    else:
+        bench_autocopy(sizes)
@@ -0,0 +1,73 @@
+# vim: ai:si:number:ts=4:et:sw=4:st=4
+"""
+Microbenchmarks for the merger. Run with the same interpreter as merger.py:
+
+    python bench_merger.py [number of file names]
+"""
+
+import sys
+import time
+import timeit
+
+import merger
+from merger import TimeExtractor
+
+START = 1393671600  # 2014-03-01 12:00:00 local time
+
+
+def make_names(count):
+    """Create file names of every instrument, one per second."""
+    names = {"osc": [], "rsa50": [], "rsa30": []}
+    for i in range(count):
+        moment = time.localtime(START + i)
+        names["osc"].append("/data/Oscil/C2/C2_{}_inj.csv".format(
+            time.strftime(TimeExtractor.osc_time, moment)))
+        names["rsa50"].append("/data/RSA51/RSA51-{}.{:06d}.TIQ".format(
+            time.strftime(TimeExtractor.osc_time, moment), i % 1000000))
+        names["rsa30"].append("/data/RSA30/{}-0001.iqt".format(
+            time.strftime(TimeExtractor.rsa30_time, moment)))
+    return names
+
+
+def strptime_osc(name):
+    """The strptime path: parse and compare via mktime."""
+    name = name.split('/')[-1].split('_')[1]
+    return time.mktime(time.strptime(name, TimeExtractor.osc_time))
+
+
+def strptime_rsa50(name):
+    name = name.split('/')[-1].split('-')[1]
+    return time.mktime(time.strptime(name, TimeExtractor.rsa50_time))
+
+
+def strptime_rsa30(name):
+    name = "-".join(name.split('/')[-1].split('-')[:-1])
+    return time.mktime(time.strptime(name, TimeExtractor.rsa30_time))
+
+
+def bench_times(count):
+    """Compare the strptime path to the sliced and cached TimeExtractor."""
+    names = make_names(count)
+    merger.CACHE_SIZE = 2 * count
+    paths = (("osc", strptime_osc, TimeExtractor.osc),
+             ("rsa50", strptime_rsa50, TimeExtractor.rsa50),
+             ("rsa30", strptime_rsa30, TimeExtractor.rsa30))
+    print("{} file names per instrument".format(count))
+    print("{:8s}{:>12s}{:>12s}{:>12s}".format(
+        "", "strptime", "sliced", "cached"))
+    for kind, slow, fast in paths:
+        kind_names = names[kind]
+        assert [int(slow(n)) for n in kind_names[:100]] == \
+            [fast(n) for n in kind_names[:100]]
+        timings = [timeit.timeit(lambda: [slow(n) for n in kind_names],
+                                 number=1)]
+        # the first pass fills the cache, the second one hits it
+        timings.append(timeit.timeit(lambda: [fast(n) for n in kind_names],
+                                     number=1))
+        timings.append(timeit.timeit(lambda: [fast(n) for n in kind_names],
+                                     number=1))
+        print("{:8s}{:>11.3f}s{:>11.3f}s{:>11.3f}s".format(kind, *timings))
+
+
+if __name__ == "__main__":
+    bench_times(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,60 @@
+"""Benchmarks for the renaming of oscilloscope traces on synthetic LeCroy
+files. Run with:
+
+    python bench_osc.py [samples ...]
+"""
+import os, sys, time, shutil, tempfile, tracemalloc
+import osc, lecroy
+from beamtime import write_trace
+
+
+def classify_list(path):
+    with open(path) as file_:
+        data, _ = osc.read_data_and_time(file_)
+        return osc.find_kind(data)
+
+
+def classify_array(path):
+    with lecroy.Trace(path) as trace:
+        return osc.find_kind_array(trace.data())
+
+
+def classify_stream(path):
+    with lecroy.Trace(path) as trace:
+        return osc.stream_kind(trace)
+
+
+def bench_classify(sizes):
+    """Compare list, array and streaming classification of inj and ext
+    traces, reporting time and peak memory."""
+    folder = tempfile.mkdtemp()
+    paths = (("list", classify_list), ("array", classify_array),
+             ("stream", classify_stream))
+    print("{:>10s}{:>6s}".format("samples", "kind") +
+          "".join("{:>20s}".format(name) for name, _ in paths))
+    try:
+        for samples in sizes:
+            for kind, width in (("inj", 0.2e-6), ("ext", 3e-6)):
+                path = os.path.join(folder, "C1Trace00000.csv")
+                # keep the pulse inside the trace
+                write_trace(path, samples, min(width, samples*0.5e-9))
+                line, kinds = "{:>10d}{:>6s}".format(samples, kind), set()
+                for name, classify in paths:
+                    start = time.time()
+                    kinds.add(classify(path))
+                    elapsed = time.time() - start
+                    # tracing slows things down, measure memory separately
+                    tracemalloc.start()
+                    classify(path)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    line += "{:>9.3f}s{:>9.1f}MB".format(elapsed, peak/1e6)
+                assert kinds == {kind}, kinds
+                print(line)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    bench_classify(sizes)
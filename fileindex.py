@@ -0,0 +1,97 @@
+"""Index of the files transferred by autocopy, kept in an sqlite database so
+that membership is answered on disk and startup does not load every name.
+Each file is recorded with its size, modification time and checksum."""
+import os, time, pickle, hashlib, sqlite3
+
+CHUNK = 1 << 20  # bytes read at once when hashing
+BATCH = 500  # names per query, below the sqlite limit of 999 parameters
+
+
+def checksum(path, algorithm="md5"):
+    """Return the hex digest of the file at path."""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as file_:
+        for chunk in iter(lambda: file_.read(CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileIndex:
+    """Transferred files by name. Only the thread which opened the index may
+    use it."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        # appends go to the write ahead log, which sqlite folds back into the
+        # database (checkpoints) as it grows
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files ("
+                        "name TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                        "checksum TEXT, transferred REAL)")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __contains__(self, name):
+        return self.db.execute("SELECT 1 FROM files WHERE name = ?",
+                               (name,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def missing(self, names):
+        """Return the set of names which are not in the index."""
+        names = list(names)
+        found = set()
+        for i in range(0, len(names), BATCH):
+            batch = names[i:i + BATCH]
+            found.update(row[0] for row in self.db.execute(
+                "SELECT name FROM files WHERE name IN (%s)" %
+                ",".join("?" * len(batch)), batch))
+        return set(names).difference(found)
+
+    def names(self):
+        """Yield all names in sorted order, read from disk as they go."""
+        return (row[0] for row in
+                self.db.execute("SELECT name FROM files ORDER BY name"))
+
+    def get(self, name):
+        """Return (size, mtime, checksum) of name or None."""
+        return self.db.execute("SELECT size, mtime, checksum FROM files "
+                               "WHERE name = ?", (name,)).fetchone()
+
+    def add(self, name, size=None, mtime=None, checksum=None):
+        """Record a transferred file."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES "
+                            "(?, ?, ?, ?, ?)",
+                            (name, size, mtime, checksum, time.time()))
+
+    def replace(self, names):
+        """Replace the contents by names (an iterable of names whose metadata
+        is unknown) and compact the database."""
+        now = time.time()
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.executemany("INSERT OR IGNORE INTO files (name, "
+                                "transferred) VALUES (?, ?)",
+                                ((name, now) for name in names))
+        self.db.execute("VACUUM")
+
+    def migrate(self, filename):
+        """Import the names from the pickled sets written by earlier versions
+        of autocopy and rename that file. Return the number of names."""
+        names = set()
+        try:
+            with open(filename, "rb") as file_:
+                # unpickles until runs into EOFError
+                while True:
+                    names.update(pickle.load(file_))
+        except (FileNotFoundError, EOFError):
+            pass
+        if names:
+            self.replace(names)
+            os.replace(filename, filename + ".migrated")
+        return len(names)
@@ -0,0 +1,108 @@
+"""Module reading the CSV traces saved by the LeCroy oscilloscope. Files are
+memory-mapped, the samples are parsed in bulk and the header of a file is
+parsed only once as long as the file does not change."""
+import os, time, mmap
+from collections import namedtuple
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+HEADER_LINES = 5  # lines before the first sample
+TIME_LINE = 3  # index of the header line holding the trigger time
+TIME_FORMAT = "%d-%b-%Y %H:%M:%S"
+CHUNK = 1 << 20  # bytes of samples parsed at once when streaming
+CACHE_SIZE = 10000  # number of headers kept
+_headers = {}
+
+# parsed header of a trace: the trigger time (struct_time), the sample
+# interval in seconds and the byte offset of the first sample
+Header = namedtuple("Header", ["stamp", "delta_t", "offset"])
+
+
+def parse_samples(text):
+    """Parse complete sample lines (bytes) into an array of (time, value)
+    rows, or a list of tuples if numpy is not available."""
+    if numpy is not None:
+        return numpy.fromstring(text.replace(b'\n', b','),
+                                sep=',').reshape(-1, 2)
+    return [tuple(map(float, line.split(b',')))
+            for line in text.splitlines() if line.strip()]
+
+
+def parse_header(view):
+    """Parse the header from the start of a memory-mapped trace."""
+    offset = 0
+    lines = []
+    for _ in range(HEADER_LINES + 2):
+        end = view.find(b'\n', offset)
+        if end < 0:
+            raise ValueError("Trace too short")
+        lines.append(view[offset:end])
+        offset = end + 1
+        if len(lines) == HEADER_LINES:
+            start = offset
+    stamp = lines[TIME_LINE].split(b',')[1].decode("ascii").strip()
+    stamp = time.strptime(stamp, TIME_FORMAT)
+    first, second = parse_samples(b'\n'.join(lines[HEADER_LINES:]) + b'\n')
+    return Header(stamp, second[0] - first[0], start)
+
+
+class Trace(object):
+    """A memory-mapped LeCroy trace, use as a context manager so the file is
+    released (on Windows it can not be renamed while it is mapped)."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file_:
+            stat = os.fstat(file_.fileno())
+            self.view = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+        self.header = _headers.get(key)
+        if self.header is None:
+            self.header = parse_header(self.view)
+            if len(_headers) >= CACHE_SIZE:
+                _headers.clear()
+            _headers[key] = self.header
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._data = None
+        self.view.close()
+
+    def chunks(self, size=CHUNK):
+        """Yield the samples in chunks of complete lines of about size bytes,
+        only the current chunk is held in memory."""
+        offset = self.header.offset
+        end = len(self.view)
+        while offset < end:
+            stop = self.view.find(b'\n', min(offset + size, end - 1))
+            stop = end if stop < 0 else stop + 1
+            text = self.view[offset:stop]
+            offset = stop
+            if text.strip():
+                yield parse_samples(text)
+
+    def data(self):
+        """Return all samples, parsed in bulk on first access."""
+        if self._data is None:
+            self._data = parse_samples(self.view[self.header.offset:])
+        return self._data
+
+    @property
+    def times(self):
+        """Column of sample times (a view of data with numpy)."""
+        data = self.data()
+        return data[:, 0] if numpy is not None else [row[0] for row in data]
+
+    @property
+    def values(self):
+        """Column of sample values (a view of data with numpy)."""
+        data = self.data()
+        return data[:, 1] if numpy is not None else [row[1] for row in data]
@@ -6,12 +6,19 @@ A module performing the merging of files during the experiment.
 import os
 import logging
 import time
-import glob
+import bisect
 import cPickle as pickle
-import shutil
+import mmap
+import struct
+import zlib
+import json
+import multiprocessing
+import datetime
 from pprint import pformat
 from subprocess import Popen, PIPE
 from functools import wraps
+import scan
+import metrics
 
 ############
 # Settings #
@@ -23,106 +30,457 @@ RSA52 = os.path.join(DATA_DIR, "RSA52")
 RSA30 = os.path.join(DATA_DIR, "RSA30")
 OSC_DIR = os.path.join(DATA_DIR, "Oscil")
 OSC_CHANS = ("C1", "C2", "C3", "C4")
-REF_CHAN = os.path.join(OSC_DIR, "C2")
+# channel and file pattern of the injection files defining the injections
+REF_CHAN = "C2"
+REF_PATTERN = "C2*inj.csv"
 # path to time2root
 T2R = "/data.local2/time2root/time2root"
+# pass all files of an injection to a single time2root call. None checks on
+# the first complete injection whether time2root converts every file passed
+# to it (see check_batch) and batches if it does
+T2R_BATCH = None
+# a batch counts as fully converted if its output has at least this fraction
+# of the size of the output converted file by file
+T2R_BATCH_RATIO = 0.5
 OUTPUT_DIR = os.path.join(DATA_DIR, "ROOT")
 LOGFILE = os.path.join(DATA_DIR, "Merger", "merging.log")
-PROCESS = os.path.join(DATA_DIR, "Merger", "processed.list")
+PROCESS = os.path.join(DATA_DIR, "Merger", "processed.journal")
+# pickled list of processed injections used by earlier versions
+PROCESS_PICKLE = os.path.join(DATA_DIR, "Merger", "processed.list")
+# checkpoint of the injections being assembled, with it files older than
+# HORIZON seconds before the oldest open injection are not read at startup
+ASSEMBLY = os.path.join(DATA_DIR, "Merger", "assembly.json")
+HORIZON = 3600  # seconds
+# nominal seconds between injections, the end of the window of an injection
+# which is not followed by another one (yet). Later files are not merged into
+# it, so this must not exceed the shortest time between injections
+CYCLE = 60
+# seconds after the nominal end of its window after which an injection is
+# merged with the files found so far, None waits for two newer injections
+DEADLINE = 60
+BACKUP_DIR = "/hera/sids/"
 CONTENT = os.path.join(DATA_DIR, "Merger", "content.list")
 PERIOD = 30  # seconds
+# number of injections merged in parallel, 1 merges in the main process
+MERGE_PROCESSES = 4
+# number of file names for which the extracted time is remembered
+CACHE_SIZE = 100000
+# metrics are served in the Prometheus text format on localhost:METRICS_PORT
+# and written to METRICS_SNAPSHOT (JSON) every METRICS_PERIOD seconds, use
+# None to disable either
+METRICS_PORT = 9102
+METRICS_SNAPSHOT = None
+METRICS_PERIOD = 60  # seconds
+
+SCAN_TIME = metrics.histogram("merger_scan_seconds",
+                              "Duration of the update of all catalogs")
+LOOP_TIME = metrics.histogram("merger_loop_seconds", "Duration of a loop")
+DISCOVERY_TIME = metrics.histogram("merger_discovery_seconds",
+                                   "Time from an injection until its files "
+                                   "were collected")
+MERGE_TIME = metrics.histogram("merger_merge_seconds",
+                               "Duration of the merge of an injection")
+MERGED = metrics.counter("merger_merged_total", "Injections merged")
+FAILURES = metrics.counter("merger_failures_total",
+                           "Injections which could not be merged")
+BACKLOG = metrics.gauge("merger_backlog_injections",
+                        "Injections collected and not merged yet")
+
+
+def name_cache(func):
+    """
+    Decorator: remember the results of a classmethod taking a file name.
+    Names are kept in two generations of CACHE_SIZE entries, names which were
+    not used during the last generation are discarded.
+    """
+    cache = {"recent": {}, "older": {}}
+
+    @wraps(func)
+    def decorated(cls, name):
+        recent = cache["recent"]
+        try:
+            return recent[name]
+        except KeyError:
+            pass
+        result = cache["older"].pop(name, None)
+        if result is None:
+            result = func(cls, name)
+        if len(recent) >= CACHE_SIZE:
+            cache["older"] = recent
+            cache["recent"] = recent = {}
+        recent[name] = result
+        return result
+
+    return decorated
 
 
 class TimeExtractor(object):
     """
     A collection of methods used to extract times from various instruments.
+    Times are returned as integer epoch seconds (local time). The known
+    layouts are sliced directly, other names fall back to strptime.
     """
     osc_time = "%Y.%m.%d.%H.%M.%S"
     rsa50_time = "%Y.%m.%d.%H.%M.%S.%f.TIQ"
     rsa30_time = "%Y%m%d-%H%M%S"
+    # epoch of the start of each hour seen, daylight saving time changes
+    # happen on full hours so the minutes and seconds can simply be added
+    hours = {}
+
+    @classmethod
+    def epoch(cls, year, month, day, hour, minute, second):
+        """Convert the time fields given as strings to epoch."""
+        key = (year, month, day, hour)
+        try:
+            start = cls.hours[key]
+        except KeyError:
+            start = int(time.mktime((int(year), int(month), int(day),
+                                     int(hour), 0, 0, 0, 0, -1)))
+            cls.hours[key] = start
+        return start + 60 * int(minute) + int(second)
+
+    @staticmethod
+    def strptime(stamp, fmt):
+        """Convert a time string to epoch using strptime."""
+        return int(time.mktime(time.strptime(stamp, fmt)))
 
     @classmethod
+    @name_cache
     def rsa30(cls, name):
         """Extract time from RSA30 IQT files."""
         name = name.split('/')[-1]
         name = name.split('-')[:-1]
         name = "-".join(name)
-        return time.strptime(name, cls.rsa30_time)
+        if len(name) == 15 and name[8] == '-':
+            try:
+                return cls.epoch(name[0:4], name[4:6], name[6:8],
+                                 name[9:11], name[11:13], name[13:15])
+            except ValueError:
+                pass
+        return cls.strptime(name, cls.rsa30_time)
 
     @classmethod
-    def rsa50(cls, name):
-        """Extract time from RSA50 TIQ files."""
+    @name_cache
+    def rsa50_us(cls, name):
+        """Extract time from RSA50 TIQ files in epoch microseconds."""
         name = name.split('/')[-1]
         name = name.split('-')[1]
-        return time.strptime(name, cls.rsa50_time)
+        if len(name) > 24 and name[19] == '.' and name.endswith(".TIQ"):
+            try:
+                return (cls.epoch(name[0:4], name[5:7], name[8:10],
+                                  name[11:13], name[14:16], name[17:19]) *
+                        1000000 + int(name[20:-4].ljust(6, '0')))
+            except ValueError:
+                pass
+        parsed = datetime.datetime.strptime(name, cls.rsa50_time)
+        return (cls.strptime(name, cls.rsa50_time) * 1000000 +
+                parsed.microsecond)
 
     @classmethod
+    def rsa50(cls, name):
+        """Extract time from RSA50 TIQ files."""
+        return cls.rsa50_us(name) // 1000000
+
+    @classmethod
+    @name_cache
     def osc(cls, name):
         """Extract time from LeCroy CSV files."""
         name = name.split('/')[-1]
         name = name.split('_')[1]
-        return time.strptime(name, cls.osc_time)
+        if len(name) == 19:
+            try:
+                return cls.epoch(name[0:4], name[5:7], name[8:10],
+                                 name[11:13], name[14:16], name[17:19])
+            except ValueError:
+                pass
+        return cls.strptime(name, cls.osc_time)
 
 
-def dir_restore(func):
-    """Changes back to start directory, regardless of what
-    a function does inside it."""
+def label(moment):
+    """Format an epoch time for log messages."""
+    return time.strftime("%m.%d.%H.%M.%S", time.localtime(moment))
 
-    @wraps(func)
-    def decorator(*ar, **kw):
-        previous = os.getcwd()
-        result = func(*ar, **kw)
-        os.chdir(previous)
-        return result
 
-    return decorator
-
-
-@dir_restore
-def get_injections(processed):
+class FileCatalog(object):
     """
-    Find and return new injections. Injections are classified according to
-    their starting point in time.
-
-    Arg:
-        processed (set): a collection of previously processed injections.
-
-    Returns:
-        A list of tuples, where each tuple contains the starting time of the
-        injection and the starting time of the next injection.
+    The files of one instrument directory, kept sorted by the time encoded
+    in their names. The directory is listed once per update and only names
+    that have not been seen before are parsed.
     """
-    os.chdir(REF_CHAN)
-
-    files_list = glob.iglob("C2*inj.csv")
-    all_times_list = (TimeExtractor.osc(f) for f in files_list)
-    times_list = [f for f in all_times_list if f not in processed]
-    times_list.sort(key=lambda x: time.mktime(x))
-    # in case S/A file have not been copied, dont merge last injection.
-    times_list = times_list[:-1]
 
-    # creates tuples of 2 subsequent injection times
-    # this is safe even in the case of only 1 entry in file_list:
-    # slices will simply be empty - brilliant.
-    interval_tuples = zip(times_list[:-1], times_list[1:])
-
-    return interval_tuples
+    def __init__(self, directory, pattern, extractor):
+        self.directory = directory
+        self.pattern = pattern
+        self.extractor = extractor
+        self.seen = set()
+        self.times = []
+        self.files = []
+        # files last modified before since (epoch) are skipped
+        self.since = None
+
+    def update(self):
+        """
+        Add the files which appeared in the directory since last update.
+        Only the new names are stat'ed. A missing directory counts as empty.
+        Return a list of tuples of time and name of the added files.
+        """
+        added = []
+        directory = os.path.abspath(self.directory)
+        try:
+            names = scan.list_dir(directory, self.pattern)
+        except OSError as e:
+            logging.warning("Could not list %s: %s", directory, e)
+            return added
+        for name in names:
+            name = os.path.join(directory, name)
+            if name in self.seen:
+                continue
+            result = scan.stat_file(name)
+            if result is None:
+                continue
+            self.seen.add(name)
+            if self.since is not None and result[1] < self.since:
+                continue
+            try:
+                file_time = self.extractor(name)
+            except (ValueError, IndexError):
+                logging.warning("Could not extract time from %s", name)
+                continue
+            index = bisect.bisect_right(self.times, file_time)
+            self.times.insert(index, file_time)
+            self.files.insert(index, name)
+            added.append((file_time, name))
+        return added
+
+    def between(self, start, stop):
+        """Return the files strictly between start and stop (epoch)."""
+        if stop < start:
+            raise ValueError("Start time is after stop time")
+        low = bisect.bisect_right(self.times, start)
+        high = bisect.bisect_left(self.times, stop)
+        return self.files[low:high]
+
+    def entries(self, start, stop=None):
+        """Return (time, name) of the files from start (epoch) up to but not
+        including stop, or all later files if stop is None."""
+        low = bisect.bisect_left(self.times, start)
+        high = len(self.times) if stop is None else \
+            bisect.bisect_left(self.times, stop)
+        return list(zip(self.times[low:high], self.files[low:high]))
+
+    def at(self, moment):
+        """Return the files with time equal to moment (epoch)."""
+        low = bisect.bisect_left(self.times, moment)
+        high = bisect.bisect_right(self.times, moment)
+        return self.files[low:high]
+
+
+CATALOGS = dict(
+    [(ch, FileCatalog(os.path.join(OSC_DIR, ch), ch + "_*.csv",
+                      TimeExtractor.osc)) for ch in OSC_CHANS] +
+    [("RSA51", FileCatalog(RSA51, "*.TIQ", TimeExtractor.rsa50)),
+     ("RSA52", FileCatalog(RSA52, "*.TIQ", TimeExtractor.rsa50)),
+     ("RSA30", FileCatalog(RSA30, "*.iqt", TimeExtractor.rsa30))])
+
+
+def update_catalogs():
+    """
+    Add new instrument files to all catalogs. Return a dictionary of the
+    added (time, name) tuples by catalog.
+    """
+    with SCAN_TIME.time():
+        return dict((name, catalog.update())
+                    for name, catalog in CATALOGS.items())
 
 
-def create_range_predicate(start, stop, tolerance=0):
+class InjectionAssembler(object):
     """
-    Create a filtering function that checks if time was within the expected
-    time range.
+    Injections which are not merged yet, with the files found for each of
+    them. New files are attached to the injection whose window (from its
+    start to the next injection) contains their time, files which were found
+    before the injection are taken from the catalogs when its window is
+    opened. An injection is ready
+    as soon as the full set of files is there, once two newer injections
+    were found (which leaves time for the S/A files to be copied) or DEADLINE
+    seconds after the nominal end of its window (CYCLE seconds after its
+    start), so the newest injection and the last one of a run are merged
+    without waiting for the next ones.
     """
-    start = time.mktime(start)
-    stop = time.mktime(stop)
-    if stop < start:
-        raise ValueError("Start time is after stop time")
-
-    def predicate(data_time):
-        data_time = time.mktime(data_time)
-        return start - tolerance < data_time < stop + tolerance
 
-    return predicate
+    def __init__(self):
+        # sorted starts of the recent injections, merged ones included so
+        # that files are attributed to the right window
+        self.starts = []
+        # files of the open injections: start -> catalog name -> list of
+        # (time, name)
+        self.windows = {}
+
+    def add_injection(self, start, processed):
+        """Open the window of a new injection unless it was processed.
+        Return True if a window was opened."""
+        index = bisect.bisect_left(self.starts, start)
+        if index < len(self.starts) and self.starts[index] == start:
+            return False
+        if index == 0 and self.starts and start not in processed:
+            logging.warning("Injection@%s found after newer ones",
+                            label(start))
+        self.starts.insert(index, start)
+        if start in processed:
+            return False
+        window = self.windows[start] = {}
+        # files of the previous window which belong to this one
+        previous = self.windows.get(self.starts[index - 1]) \
+            if index else None
+        for name, entries in (previous or {}).items():
+            previous[name] = [entry for entry in entries if entry[0] < start]
+            window[name] = [entry for entry in entries if entry[0] >= start]
+        return True
+
+    def fill(self, start):
+        """Attach the files of the catalogs in the window of an injection.
+        Files which were found before the reference file (e.g. from the
+        spectrum analyzers) had no open window to go to."""
+        index = bisect.bisect_left(self.starts, start)
+        stop = self.starts[index + 1] if index + 1 < len(self.starts) \
+            else None
+        for catalog, files in CATALOGS.items():
+            for file_time, name in files.entries(start, stop):
+                self.add_file(catalog, file_time, name)
+
+    def add_file(self, catalog, file_time, name):
+        """Attach a file to the open window containing its time."""
+        index = bisect.bisect_right(self.starts, file_time) - 1
+        if index < 0:
+            return
+        start = self.starts[index]
+        window = self.windows.get(start)
+        # only the oscilloscope saves files at the start of the window
+        if window is None or file_time == start and \
+                catalog not in OSC_CHANS:
+            return
+        entries = window.setdefault(catalog, [])
+        # files of a restored window are reported again after a restart
+        if (file_time, name) not in entries:
+            entries.append((file_time, name))
+
+    def complete(self, start, stop):
+        """
+        Return the files of the injection if all 11 of them were found
+        before stop (one injection and one extraction trace per channel, one
+        file of each spectrum analyzer), else None. Files from stop on can
+        belong to the next injection, whose reference file was not found
+        yet.
+        """
+        window = self.windows[start]
+        inj, ext, rsa = [], [], []
+        for channel in OSC_CHANS:
+            entries = [entry for entry in window.get(channel, [])
+                       if entry[0] < stop]
+            at = [name for file_time, name in entries if file_time == start]
+            after = [name for file_time, name in entries if file_time > start]
+            if len(at) != 1 or len(after) != 1:
+                return None
+            inj += at
+            ext += after
+        for catalog in ("RSA52", "RSA51", "RSA30"):
+            entries = [entry for entry in window.get(catalog, [])
+                       if entry[0] < stop]
+            if len(entries) != 1:
+                return None
+            rsa.append(entries[0][1])
+        return inj + ext + rsa
+
+    def ready(self, now=None):
+        """
+        Return a list of tuples of the start, the end of the window and the
+        files if they are complete (or None) of the injections which are
+        ready at now (epoch, default: the current time). They stay open until
+        they are closed with :py:meth:`close`, so they are returned again if
+        their merge did not finish.
+        """
+        if now is None:
+            now = time.time()
+        ready = []
+        for index, start in enumerate(self.starts):
+            if start not in self.windows:
+                continue
+            if index + 1 < len(self.starts):
+                stop = self.starts[index + 1]
+            else:
+                stop = start + CYCLE
+            files = self.complete(start, stop)
+            if files is not None:
+                ready.append((start, stop, files))
+            elif index + 2 < len(self.starts):
+                ready.append((start, stop, None))
+            elif DEADLINE is not None and now >= start + CYCLE + DEADLINE:
+                logging.info("Injection@%s: closed after the deadline",
+                             label(start))
+                ready.append((start, stop, None))
+        self.prune()
+        return ready
+
+    def close(self, start):
+        """Remove the window of a processed injection."""
+        self.windows.pop(start, None)
+        self.prune()
+
+    def prune(self):
+        """Forget the starts which are not needed any more: only the last
+        injection before the open ones is still needed."""
+        first = min([bisect.bisect_left(self.starts, start)
+                     for start in self.windows] +
+                    [max(len(self.starts) - 2, 0)])
+        del self.starts[:max(first - 1, 0)]
+
+    def horizon(self):
+        """Return the epoch before which files can be ignored or None."""
+        if not self.starts:
+            return None
+        return min(list(self.windows) + self.starts[-1:]) - HORIZON
+
+    def save(self, filename):
+        """Write the state to a checkpoint file, replacing it atomically."""
+        state = {"starts": self.starts,
+                 "windows": dict((str(start), window)
+                                 for start, window in self.windows.items())}
+        with open(filename + ".tmp", "w") as file_:
+            json.dump(state, file_)
+        os.rename(filename + ".tmp", filename)
+
+    def load(self, filename):
+        """Restore the state from a checkpoint file. Return False if there is
+        none."""
+        try:
+            with open(filename) as file_:
+                state = json.load(file_)
+        except (IOError, ValueError):
+            return False
+        self.starts = state["starts"]
+        self.windows = dict(
+            (int(start), dict((str(name), [tuple(entry) for entry in entries])
+                              for name, entries in window.items()))
+            for start, window in state["windows"].items())
+        return True
+
+    def update(self, added, processed, now=None):
+        """Attach the files added to the catalogs (as returned by
+        :py:func:`update_catalogs`) and return :py:meth:`ready`."""
+        match = scan.compile_pattern(REF_PATTERN)
+        opened = [file_time for file_time, name in
+                  sorted(added.get(REF_CHAN, []))
+                  if match(os.path.basename(name)) and
+                  self.add_injection(file_time, processed)]
+        # once all new injections are known, so that each window is bounded
+        for start in opened:
+            self.fill(start)
+        for catalog, entries in added.items():
+            for file_time, name in entries:
+                self.add_file(catalog, file_time, name)
+        return self.ready(now)
+
+
+ASSEMBLER = InjectionAssembler()
 
 
 def check_output(n, message, minimum):
@@ -138,12 +496,12 @@ def check_output(n, message, minimum):
             data = func(start, *args)
             if len(data) != n:
                 logging.warning("Injection@%s: found %d %s files",
-                                time.strftime("%m.%d.%H.%M.%S", start),
+                                label(start),
                                 len(data), message)
                 if len(data) < minimum or len(data) > n:
                     logging.error("Injection@%s: amount of %s files is not "
                                   "between %d and %d.",
-                                  time.strftime("%m.%d.%H.%M.%S", start),
+                                  label(start),
                                   message, minimum, n)
                     data = []
             return data
@@ -158,43 +516,31 @@ def get_inj_files(start):
     """Retrieve oscilloscope injection files"""
     data = []
     for channel in OSC_CHANS:
-        glob_str = "{osc}/{ch}/{ch}_{tm}_*.csv".format(
-            osc=OSC_DIR, ch=channel,
-            tm=time.strftime(TimeExtractor.osc_time, start))
-        found_files = glob.glob(glob_str)
-        data.extend(found_files)
+        data.extend(CATALOGS[channel].at(start))
     return data
 
 
 @check_output(4, "osc ext", 4)
-def get_ext_files(start, predicate):
+def get_ext_files(start, stop):
     """Retrieve oscilloscope extraction files"""
     data = []
     for channel in OSC_CHANS:
-        glob_str = "{osc}/{ch}/{ch}_*.csv".format(osc=OSC_DIR, ch=channel)
-        found_files = [f for f in glob.glob(glob_str)
-                       if predicate(TimeExtractor.osc(f))]
-        data.extend(found_files)
+        data.extend(CATALOGS[channel].between(start, stop))
     return data
 
 
-def get_osc_files(start, predicate):
+def get_osc_files(start, stop):
     """Retrieve oscilloscope files."""
     data = get_inj_files(start)
-    data += get_ext_files(start, predicate)
+    data += get_ext_files(start, stop)
     return data
 
 
 @check_output(2, "rsa50", 1)
-def get_rsa50_files(start, predicate):
+def get_rsa50_files(start, stop):
     data = []
-    glob_str = "{rsa}/*.TIQ".format(rsa=RSA52)
-    found_files = [f for f in glob.glob(glob_str)
-                   if predicate(TimeExtractor.rsa50(f))]
-    data += found_files
-    glob_str = "{rsa}/*.TIQ".format(rsa=RSA51)
-    found_files = [f for f in glob.glob(glob_str)
-                   if predicate(TimeExtractor.rsa50(f))]
+    data += CATALOGS["RSA52"].between(start, stop)
+    found_files = CATALOGS["RSA51"].between(start, stop)
     found_rsa51 = True if len(found_files) == 1 else False
     data += found_files
     if not found_rsa51:
@@ -203,11 +549,8 @@ def get_rsa50_files(start, predicate):
 
 
 @check_output(1, "rsa30", 0)
-def get_rsa30_files(start, predicate):
-    glob_str = "{rsa}/*.iqt".format(rsa=RSA30)
-    found_files = [f for f in glob.glob(glob_str)
-                   if predicate(TimeExtractor.rsa30(f))]
-    return found_files
+def get_rsa30_files(start, stop):
+    return CATALOGS["RSA30"].between(start, stop)
 
 
 def log_contents(root_name, data):
@@ -233,47 +576,217 @@ def log_contents(root_name, data):
         file_.write("{}\n".format(stars))
 
 
-@dir_restore
-def merge(start, data, debug=False):
+def run_t2r(output_path, files):
+    """
+    Run time2root once with the given input files.
+
+    Returns:
+        A tuple of the exit code, standard output and standard error.
     """
-    Merge the gathered files using time2root.
+    # time2root runs in its own directory
+    proc = Popen([T2R, output_path] + list(files), stdout=PIPE, stderr=PIPE,
+                 cwd=os.path.dirname(T2R))
+    output, err = proc.communicate()
+    return proc.wait(), output, err
+
+
+def merge(start, data, debug=False, batch=False):
     """
-    output_filename = time.strftime(TimeExtractor.osc_time, start) + ".root"
+    Merge the gathered files using time2root and return the name of the
+    ROOT file.
+
+    The files are converted into a partial file which replaces the ROOT file
+    when all are done, so an injection merged again after a crash does not
+    append its files twice.
+
+    With batch all files are converted by one time2root process. If that
+    fails the partial output is removed and the files are converted one by
+    one, so that the failing file can be reported.
+    """
+    output_filename = time.strftime(TimeExtractor.osc_time,
+                                    time.localtime(start)) + ".root"
     # get absolute path to output files
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
+    output_path = os.path.abspath(os.path.join(OUTPUT_DIR, output_filename))
+    partial_path = os.path.join(os.path.dirname(output_path),
+                                "partial." + output_filename)
     # get absolute path to input files
     data = [os.path.abspath(file_) for file_ in data]
-    # change directory to time2root dir
-    os.chdir(os.path.dirname(T2R))
+    if os.path.exists(partial_path):
+        os.remove(partial_path)
+    if batch:
+        out, output, err = run_t2r(partial_path, data)
+        if out == 0:
+            if os.path.exists(partial_path):
+                os.rename(partial_path, output_path)
+            return output_filename
+        logging.warning("Injection@%s: batched T2R failed with code %d, "
+                        "converting files one by one",
+                        label(start), out)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
     for file_ in data:
-        proc = Popen([T2R, output_path, file_], stdout=PIPE, stderr=PIPE)
-        output, err = proc.communicate()
-        out = proc.wait()
+        out, output, err = run_t2r(partial_path, [file_])
         if out != 0:
             ## Temporary fix to see if this helps
             logging.error("Injection@%s: T2R failed at %s with code %d",
-                          time.strftime("%m.%d.%H.%M.%S", start),
+                          label(start),
                           file_.split('/')[-1],
                           out)
             logging.error("Error message and output: %s %s", output, err)
-    log_contents(output_filename, data)
+    if os.path.exists(partial_path):
+        os.rename(partial_path, output_path)
+    return output_filename
+
+
+def check_batch(start, data):
+    """
+    Find out whether time2root converts all files passed to it at once:
+    merge the injection file by file, which gives its ROOT file, and as one
+    batch into a scratch file, and compare the sizes of the two. A time2root
+    which only converts its first input gives a much smaller batch. Sets
+    T2R_BATCH once it could be decided.
+
+    Returns:
+        The name of the ROOT file.
+    """
+    global T2R_BATCH
+    output_filename = merge(start, data)
+    if len(data) != 11:
+        # only compared on complete injections
+        return output_filename
+    output_path = os.path.abspath(os.path.join(OUTPUT_DIR, output_filename))
+    check_path = os.path.join(os.path.dirname(output_path),
+                              "check." + output_filename)
+    if os.path.exists(check_path):
+        os.remove(check_path)
+    out, output, err = run_t2r(check_path,
+                               [os.path.abspath(file_) for file_ in data])
+    single = os.path.getsize(output_path) \
+        if os.path.exists(output_path) else 0
+    batched = os.path.getsize(check_path) \
+        if os.path.exists(check_path) else 0
+    if os.path.exists(check_path):
+        os.remove(check_path)
+    if not single:
+        logging.warning("Injection@%s: no output to check batched T2R "
+                        "against", label(start))
+        return output_filename
+    T2R_BATCH = out == 0 and batched >= T2R_BATCH_RATIO * single
+    logging.info("Batched T2R gave %d bytes (code %d), file by file %d "
+                 "bytes: %s", batched, out, single,
+                 "batching" if T2R_BATCH else "converting file by file")
+    return output_filename
+
+
+def merge_job(job):
+    """
+    Merge a single injection, used as the worker function of the merge pool.
+
+    Arg:
+        job (tuple): the injection start time, the files to merge, or None
+                     if the injection can not be merged, and whether to
+                     convert them in one batch, None runs
+                     :py:func:`check_batch`.
+
+    Returns:
+        The name of the ROOT file or None if nothing was merged, and the
+        seconds the merge took.
+    """
+    start, data, batch = job
+    if data is None:
+        return None, 0
+    began = time.time()
+    if batch is None:
+        output_filename = check_batch(start, data)
+    else:
+        output_filename = merge(start, data, batch=batch)
+    return output_filename, time.time() - began
+
+
+# journal record: epoch seconds and the CRC32 of their packed bytes
+RECORD = struct.Struct("<qI")
+STAMP = struct.Struct("<q")
+
+
+def pack_record(start):
+    """Pack an injection start time (epoch) into a journal record."""
+    stamp = STAMP.pack(start)
+    return stamp + struct.pack("<I", zlib.crc32(stamp) & 0xffffffff)
 
 
 def save_processed(filename, processed):
     """
-    Pickle a data collection (set) and append it to a file.
+    Append a data collection (set) of injection times to the journal.
 
     Args:
         filename (str): the name of the file to which to write.
         processed (set): the collection which will be appended to file.
     """
+    records = "".join(pack_record(start) for start in processed)
     with open(filename, "ab") as file_:
-        pickle.dump(processed, file_, 0)
+        file_.write(records)
+
+
+def read_journal(filename):
+    """
+    Read all valid records of a journal. Records with a wrong checksum are
+    skipped. A partial record at the end (a torn write) is cut off so that
+    new records can be appended.
+
+    Arg:
+        filename (str): the name of the file from which to read.
+
+    Returns:
+        A list of the epoch times of the records.
+    """
+    stamps = []
+    with open(filename, "r+b") as file_:
+        size = os.fstat(file_.fileno()).st_size
+        valid = size - size % RECORD.size
+        if valid != size:
+            logging.warning("Cutting %d bytes of a partial record from %s",
+                            size - valid, filename)
+            file_.truncate(valid)
+        if not valid:
+            return stamps
+        journal = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in xrange(0, valid, RECORD.size):
+                stamp, crc = RECORD.unpack_from(journal, offset)
+                if zlib.crc32(journal[offset:offset + STAMP.size]) \
+                        & 0xffffffff != crc:
+                    logging.error("Skipping corrupt record %d of %s",
+                                  offset // RECORD.size, filename)
+                    continue
+                stamps.append(stamp)
+        finally:
+            journal.close()
+    return stamps
 
 
 def get_processed(filename):
     """
-    Unpickle all sets contained within a file.
+    Read the injection times contained within a journal.
+
+    Arg:
+        filename (str): the name of the file from which to read.
+
+    Returns:
+        A set of all injection times (epoch as returned by
+        :py:meth:`TimeExtractor.osc`) contained within the file.
+    """
+    try:
+        stamps = read_journal(filename)
+    except IOError:
+        # if file doesn't exist will create an empty file.
+        open(filename, "ab").close()
+        stamps = []
+    return set(stamps)
+
+
+def get_pickled(filename):
+    """
+    Unpickle all sets contained within a file written by earlier versions.
 
     Arg:
         filename (str): the name of the file from which to read.
@@ -286,60 +799,141 @@ def get_processed(filename):
         with open(filename, "rb") as processed_file:
             while True:
                 processed.update(pickle.load(processed_file))
-    except EOFError:
-        # expected
+    except (EOFError, IOError):
         pass
-    except IOError:
-        # if file doesn't exist will create a file with an empty set.
-        save_processed(filename, processed)
     return processed
 
 
-def loop(processed):
+def collect(start, stop):
+    """
+    Find the files of an injection which was not completed in the file
+    catalogs, checking that enough of them are there.
+
+    Returns:
+        The list of files to merge or None if the injection can not be
+        merged.
+    """
+    data2merge = []
+    data2merge += get_osc_files(start, stop)
+    rsa50_files = get_rsa50_files(start, stop)
+    found_rsa51 = True if len(rsa50_files) >= 1 else False
+    data2merge += rsa50_files
+    data2merge += get_rsa30_files(start, stop)
+    if found_rsa51 and 9 <= len(data2merge) <= 11:
+        return data2merge
+    if stop - start > 1.5 * 60:
+        logging.error("Injection@%s had next inj after "
+                      "%d seconds",
+                      label(start),
+                      stop - start)
+    if not found_rsa51:
+        logging.error("Injection@%s: did not find 1 rsa51 file",
+                      label(start))
+    logging.error("Injection@%s could not be merged",
+                  label(start))
+    return None
+
+
+def loop(processed, pool=None):
     """
     The program loop, made up of the following steps:
 
-        1. Find all not processed injection files from oscilloscope
-           (default: C2)
-        2. Find S/A and extraction files belonging to each injection.
+        1. Add the new files of all instruments to the file catalogs and
+           attach them to the injections (defined by the injection files
+           of the reference channel, default: C2) in the
+           :py:class:`InjectionAssembler`.
+        2. Take the injections with all files, and the injections followed
+           by two newer ones or still incomplete DEADLINE seconds after the
+           nominal end of their window, for which the files are collected
+           from the catalogs.
         3. Create a root file if all raw files have been found or log failure.
+           Injections are merged in parallel if a pool is given.
 
     Args:
         processed (set): a set of already processed injections as returned
                          by :py:func:`get_processed`.
+        pool (multiprocessing.Pool): the pool used for merging, if None
+                                     injections are merged one by one.
     """
-    injections = get_injections(processed)
-    for start, stop in injections:
-        predicate = create_range_predicate(start, stop)
-        data2merge = []
-        data2merge += get_osc_files(start, predicate)
-        rsa50_files = get_rsa50_files(start, predicate)
-        found_rsa51 = True if len(rsa50_files) >= 1 else False
-        data2merge += rsa50_files
-        data2merge += get_rsa30_files(start, predicate)
-        if found_rsa51 and 9 <= len(data2merge) <= 11:
-            merge(start, data2merge)
+    looped = time.time()
+    jobs = []
+    for start, stop, data2merge in ASSEMBLER.update(update_catalogs(),
+                                                    processed):
+        if start in processed:
+            # merged before the last checkpoint was written
+            ASSEMBLER.close(start)
+            continue
+        DISCOVERY_TIME.observe(time.time() - start)
+        if data2merge is None:
+            data2merge = collect(start, stop)
+        jobs.append((start, data2merge))
+    began = time.time()
+    merged = 0
+    BACKLOG.set(len(jobs))
+    if pool is not None and T2R_BATCH is not None:
+        results = pool.imap(merge_job, [(start, data, T2R_BATCH)
+                                        for start, data in jobs])
+    else:
+        # until time2root was checked, injections are merged here, reading
+        # T2R_BATCH as check_batch sets it
+        results = (merge_job((start, data, T2R_BATCH))
+                   for start, data in jobs)
+    # results come back in submission order, so bookkeeping stays ordered
+    for (start, data), (output_filename, duration) in zip(jobs, results):
+        if output_filename is not None:
+            log_contents(output_filename, data)
             logging.info("Successfully merged injection@%s",
-                         time.strftime("%m.%d.%H.%M.%S", start))
+                         label(start))
+            merged += 1
+            MERGED.inc()
+            MERGE_TIME.observe(duration)
         else:
-            if time.mktime(stop) - time.mktime(start) > 1.5 * 60:
-                logging.error("Injection@%s had next inj after "
-                              "%d seconds",
-                              time.strftime("%m.%d.%H.%M.%S", start),
-                              time.mktime(stop) - time.mktime(start))
-            if not found_rsa51:
-                logging.error("Injection@%s: did not find 1 rsa51 file",
-                              time.strftime("%m.%d.%H.%M.%S", start))
-            logging.error("Injection@%s could not be merged",
-                          time.strftime("%m.%d.%H.%M.%S", start))
+            FAILURES.inc()
+        BACKLOG.set(BACKLOG.value - 1)
         processed.add(start)
         save_processed(PROCESS, set([start]))
+        ASSEMBLER.close(start)
+    ASSEMBLER.save(ASSEMBLY)
+    elapsed = time.time() - began
+    if merged:
+        logging.info("Merged %d injections in %.1f s (%.1f injections/min)",
+                     merged, elapsed, merged * 60. / max(elapsed, 1e-3))
+    LOOP_TIME.observe(time.time() - looped)
     logging.info("Finished loop")
 
 
 def backup_list():
-    """Backup the list of processed injections to a different directory"""
-    shutil.copy(PROCESS, "/hera/sids/")
+    """
+    Backup the list of processed injections to a different directory.
+    Only the whole records appended since the last backup are copied. The
+    backup is not touched if the journal does not continue it (e.g. it got
+    shorter), so that records are never lost from both.
+    """
+    backup = os.path.join(BACKUP_DIR, os.path.basename(PROCESS))
+    size = os.path.getsize(PROCESS)
+    size -= size % RECORD.size
+    try:
+        copied = os.path.getsize(backup)
+    except OSError:
+        copied = 0
+    # a partial record left by earlier versions is overwritten
+    copied -= copied % RECORD.size
+    with open(PROCESS, "rb") as source:
+        if copied:
+            source.seek(copied - RECORD.size)
+            with open(backup, "rb") as dest:
+                dest.seek(copied - RECORD.size)
+                continued = dest.read(RECORD.size) == \
+                    source.read(RECORD.size)
+            if copied > size or not continued:
+                logging.error("%s does not continue the backup %s, not "
+                              "updating it", PROCESS, backup)
+                return
+        source.seek(copied)
+        with open(backup, "r+b" if os.path.exists(backup) else "wb") as dest:
+            dest.seek(copied)
+            dest.write(source.read(size - copied))
+            dest.truncate()
 
 
 def main():
@@ -348,17 +942,33 @@ def main():
     loop and sleeping till the end of time.
     """
     i = 0
+    metrics.start(METRICS_PORT, METRICS_SNAPSHOT, METRICS_PERIOD)
     os.chdir(DATA_DIR)
     processed = get_processed(PROCESS)
+    if not processed and os.path.exists(PROCESS_PICKLE):
+        processed = set(int(time.mktime(start))
+                        for start in get_pickled(PROCESS_PICKLE))
+        save_processed(PROCESS, processed)
+        logging.info("Converted %d processed injections from %s",
+                     len(processed), PROCESS_PICKLE)
+    if ASSEMBLER.load(ASSEMBLY):
+        horizon = ASSEMBLER.horizon()
+        for catalog in CATALOGS.values():
+            catalog.since = horizon
+        logging.info("Restored %d open injections from %s, skipping files "
+                     "before %s", len(ASSEMBLER.windows), ASSEMBLY,
+                     label(horizon) if horizon is not None else "none")
+    pool = None
+    if MERGE_PROCESSES > 1:
+        pool = multiprocessing.Pool(MERGE_PROCESSES)
     while True:
         try:
-            loop(processed)
+            loop(processed, pool)
             backup_list()
         except Exception as exc:
             logging.exception("Something aweful happened!")
         time.sleep(PERIOD)
-        print
-        "Ping", i
+        print("Ping %d" % i)
         i += 1
 
 
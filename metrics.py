@@ -0,0 +1,187 @@
+"""Counters, gauges and histograms kept by autocopy and merger. They are
+served as text in the Prometheus exposition format by a local HTTP server
+and can be written periodically to a JSON snapshot file. Works with Python 2
+and 3."""
+import os, json, time, bisect, logging, threading
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+# upper bounds of the histogram buckets in seconds
+TIME_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+# upper bounds of the histogram buckets in bytes
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+_metrics = {}
+_lock = threading.Lock()
+
+
+class Counter(object):
+    """A value which only goes up, e.g. the number of failed transfers."""
+    kind = "counter"
+
+    def __init__(self, name, help_):
+        self.name = name
+        self.help = help_
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def lines(self):
+        return ["%s %s" % (self.name, _number(self.value))]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge(Counter):
+    """A value which goes up and down, e.g. the number of queued files."""
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(object):
+    """Observed values counted in buckets, with their sum and count."""
+    kind = "histogram"
+
+    def __init__(self, name, help_, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+
+    def time(self):
+        """Return a context manager observing the seconds it was open."""
+        return _Timer(self)
+
+    def lines(self):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' %
+                         (self.name, _number(bound), cumulative))
+        lines.append("%s_sum %s" % (self.name, _number(total)))
+        lines.append("%s_count %d" % (self.name, cumulative))
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return {"buckets": [[bound, count] for bound, count in
+                                zip(self.buckets + ("+Inf",), self.counts)],
+                    "sum": self.sum, "count": sum(self.counts)}
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.time() - self.start)
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _get(cls, name, help_, *args):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = cls(name, help_, *args)
+        return _metrics[name]
+
+
+def counter(name, help_):
+    """Return the counter called name, creating it on first use."""
+    return _get(Counter, name, help_)
+
+
+def gauge(name, help_):
+    """Return the gauge called name, creating it on first use."""
+    return _get(Gauge, name, help_)
+
+
+def histogram(name, help_, buckets=TIME_BUCKETS):
+    """Return the histogram called name, creating it on first use."""
+    return _get(Histogram, name, help_, buckets)
+
+
+def exposition():
+    """Return all metrics in the Prometheus text format."""
+    lines = []
+    for name, metric in sorted(_metrics.items()):
+        lines.append("# HELP %s %s" % (name, metric.help))
+        lines.append("# TYPE %s %s" % (name, metric.kind))
+        lines.extend(metric.lines())
+    return "\n".join(lines) + "\n"
+
+
+def write_snapshot(filename):
+    """Write all metrics to a JSON file, replacing it atomically."""
+    data = {"time": time.time(),
+            "metrics": dict((name, metric.snapshot())
+                            for name, metric in _metrics.items())}
+    temp = filename + ".tmp"
+    with open(temp, "w") as file_:
+        json.dump(data, file_, indent=1, sort_keys=True)
+    getattr(os, "replace", os.rename)(temp, filename)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = exposition().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start(port=None, snapshot=None, period=60, host="127.0.0.1"):
+    """Serve the metrics on host:port and write them to the snapshot file
+    every period seconds, both from daemon threads. Either can be None."""
+    logger = logging.getLogger("metrics")
+    if port is not None:
+        try:
+            server = HTTPServer((host, port), _Handler)
+        except (IOError, OSError) as e:
+            logger.error("Can't serve metrics on port %d: %s", port, e)
+        else:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            logger.info("Serving metrics on http://%s:%d/", host, port)
+    if snapshot is not None:
+        def write():
+            while True:
+                time.sleep(period)
+                try:
+                    write_snapshot(snapshot)
+                except (IOError, OSError) as e:
+                    logger.error("Can't write metrics to '%s': %s",
+                                 snapshot, e)
+        thread = threading.Thread(target=write)
+        thread.daemon = True
+        thread.start()
@@ -1,10 +1,23 @@
 """Module dealing with the renaming and proper naming of the files saved
 by the oscilloscope."""
-import glob, time, os, logging
+import time, os, logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import lecroy
+import scan
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 LIMIT = 1  # discriminating pulsewidth (fwhm) in microseconds
+OUTPUT_FORMAT = "%Y.%m.%d.%H.%M.%S"  # time format used in the filenames
+PROCESSES = None  # processes used for renaming, None uses all cores
+SETTLE = 5  # seconds a file has to be unchanged before it is renamed
 FAILED = set()
+_pool = None
+_caches = {}
 
 def parse_time(line):
     """Parse time from lecroy data and return time to use for filename."""
@@ -13,9 +26,8 @@ def parse_time(line):
     # parse time from file
     input_format = "%d-%b-%Y %H:%M:%S"
     time_str = time.strptime(line, input_format)
-    output_format = "%Y.%m.%d.%H.%M.%S"
     # reformat time_str
-    time_str = time.strftime(output_format, time_str)
+    time_str = time.strftime(OUTPUT_FORMAT, time_str)
     return time_str
 
 def find_kind(data):
@@ -30,51 +42,127 @@ def find_kind(data):
     pulse_len *= delta_t
     return "ext" if pulse_len>LIMIT*1e-6 else "inj"
 
-def read_data_and_time(file_):
+def find_kind_array(data):
+    """Vectorized version of find_kind for an array of (time, value) rows."""
+    values = data[:, 1]
+    middle = (values.max()+values.min())*0.5
+    delta_t = data[1, 0] - data[0, 0]
+    pulse_len = int(numpy.count_nonzero(values > middle))
+    pulse_len *= delta_t
+    return "ext" if pulse_len>LIMIT*1e-6 else "inj"
+
+def read_header(file_):
+    """Skip the header and return the time from it."""
     # skip first 3 lines
     for i in range(3):
-        next(file_)
+        file_.readline()
     # next line has time
-    time_str = parse_time(next(file_))
+    time_str = parse_time(file_.readline())
     # next line is worthless
-    next(file_)
+    file_.readline()
+    return time_str
+
+def stream_kind(trace):
+    """Determine the kind of a lecroy.Trace like find_kind, but go through
+    the samples in chunks so memory use does not depend on the trace length.
+    The first pass finds the extrema, the second one counts samples above the
+    middle and stops as soon as the pulse is longer than LIMIT."""
+    max_val = min_val = None
+    for chunk in trace.chunks():
+        if numpy is not None:
+            chunk_max, chunk_min = chunk[:, 1].max(), chunk[:, 1].min()
+        else:
+            chunk_max = max(chunk, key=lambda x: x[1])[1]
+            chunk_min = min(chunk, key=lambda x: x[1])[1]
+        if max_val is None:
+            max_val, min_val = chunk_max, chunk_min
+        else:
+            max_val, min_val = max(max_val, chunk_max), min(min_val, chunk_min)
+    middle = (max_val+min_val)*0.5
+    delta_t = trace.header.delta_t
+    pulse_len = 0
+    for chunk in trace.chunks():
+        if numpy is not None:
+            pulse_len += int(numpy.count_nonzero(chunk[:, 1] > middle))
+        else:
+            pulse_len += sum(1 if entry[1] > middle else 0 for entry in chunk)
+        if pulse_len*delta_t > LIMIT*1e-6:
+            return "ext"
+    return "inj"
+
+def read_data_and_time(file_):
+    time_str = read_header(file_)
     data = [tuple(map(float, line.split(','))) for line in file_]
     return data, time_str
 
+def correct_name(old_name):
+    """Return the name in the correct format for a saved file."""
+    with lecroy.Trace(old_name) as trace:
+        time_str = time.strftime(OUTPUT_FORMAT, trace.header.stamp)
+        # get kind of measurement based on pulse width
+        kind = stream_kind(trace)
+    channel = os.path.basename(old_name)[:2]
+    return "{ch}_{tm}_{tp}.{ext}".format(tm=time_str, ch=channel,
+                                         tp=kind, ext="csv")
+
 def rename(old_name):
     """Rename saved file to the correct format."""
-    with open(old_name) as fh:
-        data, time_str = read_data_and_time(fh)
-        # get kind of measurement based on pulse width
-        kind = find_kind(data)
-    channel = old_name[:2]
-    new_name = "{ch}_{tm}_{tp}.{ext}".format(tm=time_str, ch=channel,
-                                             tp=kind, ext="csv")
+    new_name = os.path.join(os.path.dirname(old_name), correct_name(old_name))
     os.rename(old_name, new_name)
     return new_name
 
-def reject_new(file_list, limit=5):
-    """Filter out files modified less than 5 seconds ago."""
-    now = time.time()
-    def access_time_filter(name):
-        return abs(now - os.stat(name).st_mtime) > limit
-    return filter(access_time_filter, file_list)
+def get_pool():
+    """Return the process pool used for parsing, starting it on first use."""
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(PROCESSES)
+    return _pool
+
+def reset_pool():
+    """Discard a broken pool (e.g. a worker was killed), the next call of
+    get_pool starts a new one."""
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False)
+        _pool = None
 
-def rename_all(path):
+def rename_all(path, cache=None):
+    """Rename all settled traces in path. If no scan.FileCache of path is
+    given, one kept by this module is refreshed."""
     logger = logging.getLogger("autocopy.osc")
-    # save start directory
-    prev = os.getcwd()
-    # go to local file directory
-    os.chdir(path)
+    if cache is None:
+        if path not in _caches:
+            _caches[path] = scan.FileCache(path, SETTLE)
+        cache = _caches[path]
+        cache.refresh()
     # find all not-renamed files
-    old_files_list = set(glob.glob("*Trace*.csv")) - FAILED
-    old_files_list = reject_new(old_files_list)
-    for old_name in old_files_list:
+    old_files_list = [name for name in cache.names("*Trace*.csv")
+                      if name not in FAILED and cache.settled(name)]
+    if not old_files_list:
+        return
+    # parse in the pool, rename here as soon as a file is classified
+    try:
+        futures = {get_pool().submit(correct_name,
+                                     os.path.join(path, old_name)): old_name
+                   for old_name in old_files_list}
+    except BrokenProcessPool as e:
+        logger.error("Renaming pool is broken, restarting it: %s", e)
+        reset_pool()
+        return
+    for future in as_completed(futures):
+        old_name = futures[future]
         try:
-            new_name = rename(old_name)
+            new_name = future.result()
+            os.rename(os.path.join(path, old_name),
+                      os.path.join(path, new_name))
+            cache.rename(old_name, new_name)
             logger.info("Renamed '%s' to '%s'", old_name, new_name)
+        except BrokenProcessPool as e:
+            # not the fault of the file, it is tried again next time
+            logger.error("Renaming pool broke while parsing '%s': %s",
+                         old_name, e)
+            reset_pool()
         except Exception as e:
             FAILED.add(old_name)
             logger.error("Caught exception while renaming '%s':\n%s:%s",
                          old_name, type(e), e)
-    os.chdir(prev)
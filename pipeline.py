@@ -0,0 +1,163 @@
+"""Pipelined runtime of autocopy (Python 3.5+). Discovery (scan, rename and
+change notifications), the settle check, the transfers and the recording in
+the index run as concurrent asyncio stages connected by bounded queues, so a
+file moves on as soon as it qualifies and a slow transfer does not hold up
+the discovery of the next shot. Blocking work (scans, renaming, transfer
+processes, hashing) runs in threads and is awaited; the index is only used
+from the event loop."""
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Pipeline:
+    """The stages of autocopy. app is the autocopy module, whose settings,
+    cache, transport and transfer pool are used."""
+    def __init__(self, app, processed, watch=None, size=1000):
+        self.app = app
+        self.processed = processed
+        self.watch = watch
+        self.pool = app.get_pool()
+        self.workers = app.THREAD_MAX or app.THREAD_LIMIT
+        self.loop = asyncio.new_event_loop()
+        self.scanner = ThreadPoolExecutor(1)
+        self.executor = ThreadPoolExecutor(self.workers + 1)
+        self.size = size
+        # queues and condition are made in the event loop
+        self.found = self.ready = self.done = self.slots = None
+        self.active = 0
+        self.count = 0
+        # names between discovery and recording, with the times they were
+        # found, settled, started and finished
+        self.stamps = {}
+
+    def blocking(self, executor, func, *args):
+        return self.loop.run_in_executor(executor, func, *args)
+
+    async def discover(self):
+        """Scan the data folder and wait for notifications, queueing the new
+        files. Closed files are complete and skip the settle check."""
+        app = self.app
+        while True:
+            poll = self.watch is None or self.watch.reconcile_due()
+            if app.rename or poll:
+                await self.blocking(self.scanner, app.refresh)
+            if app.rename:
+                await self.blocking(self.scanner, app.osc.rename_all,
+                                    app.PATH_TO_DATA, app.cache)
+            found = app.check_local() if poll else set()
+            if self.watch is not None:
+                closed = await self.blocking(self.scanner, self.watch.wait,
+                                             app.PERIOD)
+            else:
+                closed = set()
+            closed = self.processed.missing(closed).difference(self.stamps)
+            found = self.processed.missing(found).difference(self.stamps)
+            for name in sorted(found | closed):
+                entry = app.cache.entries.get(name)
+                self.stamps[name] = [entry.first_seen if entry is not None
+                                     else time.time()]
+                # waits while the queues are full
+                if name in closed:
+                    await self.put_ready(name)
+                else:
+                    await self.found.put(name)
+            app.BACKLOG.set(len(self.stamps))
+            if self.watch is None:
+                await asyncio.sleep(app.PERIOD)
+
+    async def settle(self):
+        """Pass on files once they stopped changing, dropping the ones which
+        disappeared (e.g. were renamed)."""
+        app = self.app
+        waiting = set()
+        checked = 0
+        while True:
+            try:
+                waiting.add(await asyncio.wait_for(
+                    self.found.get(), 1 if waiting else None))
+            except asyncio.TimeoutError:
+                pass
+            if time.time() - checked < 1:
+                continue
+            checked = time.time()
+            for name in sorted(waiting):
+                if app.cache.settled(name):
+                    waiting.discard(name)
+                    await self.put_ready(name)
+                elif name not in app.cache.entries:
+                    waiting.discard(name)
+                    del self.stamps[name]
+
+    async def put_ready(self, name):
+        """Queue a settled file for transfer, in the order of the pool."""
+        self.stamps[name].append(time.time())
+        self.count += 1
+        await self.ready.put((self.pool.key(name), self.count, name))
+
+    async def transfer(self):
+        """Transfer files in a thread, as many at once as the controller of
+        the pool allows."""
+        controller = self.pool.controller
+        while True:
+            _, _, name = await self.ready.get()
+            async with self.slots:
+                await self.slots.wait_for(
+                    lambda: self.active < controller.limit)
+                self.active += 1
+            if not self.ready.empty():
+                controller.saturated = True
+            self.stamps[name].append(time.time())
+            try:
+                ok = await self.blocking(self.executor, self.pool.run, name)
+            finally:
+                async with self.slots:
+                    self.active -= 1
+                    self.slots.notify_all()
+            self.stamps[name].append(time.time())
+            await self.done.put((name, ok))
+
+    async def record(self):
+        """Add transferred files to the index and log their latency. Failed
+        files are found again by the next scan."""
+        app = self.app
+        while True:
+            name, ok = await self.done.get()
+            if ok:
+                values = await self.blocking(self.executor, app.describe,
+                                             name)
+                self.processed.add(name, *values)
+                found, settled, started, finished = self.stamps[name]
+                app.SETTLE_TIME.observe(settled - found)
+                app.LATENCY.observe(time.time() - found)
+                app.logger.info("Latency of '%s': %.1f s (%.1f s settling, "
+                                "%.1f s queued, %.1f s transfer)", name,
+                                time.time() - found, settled - found,
+                                started - settled, finished - started)
+            del self.stamps[name]
+            app.BACKLOG.set(len(self.stamps))
+
+    async def main(self):
+        self.found = asyncio.Queue(self.size)
+        self.ready = asyncio.PriorityQueue(self.size)
+        self.done = asyncio.Queue(self.size)
+        self.slots = asyncio.Condition()
+        stages = [self.discover(), self.settle(), self.record()] + \
+            [self.transfer() for _ in range(self.workers)]
+        tasks = [self.loop.create_task(stage) for stage in stages]
+        # the stages run forever, stop at the first one that fails
+        done, _ = await asyncio.wait(tasks,
+                                     return_when=asyncio.FIRST_EXCEPTION)
+        for task in tasks:
+            task.cancel()
+        for task in done:
+            task.result()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.main())
+        finally:
+            self.loop.close()
+            self.executor.shutdown(wait=False)
+            self.scanner.shutdown(wait=False)
@@ -0,0 +1,119 @@
+"""Module scanning directories with os.scandir and keeping the metadata of
+the files, so that every tick costs one directory scan instead of a stat call
+per file. Nothing here changes the working directory, so scans can run in
+parallel threads."""
+import os, re, stat, time, fnmatch, threading
+from collections import namedtuple
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+
+# size and mtime of a file, when they were first and last seen changing and
+# how many scans found them unchanged
+Entry = namedtuple("Entry", ["size", "mtime", "first_seen", "changed",
+                             "checks"])
+_patterns = {}
+
+
+def compile_pattern(pattern):
+    """Return a function matching names against the glob pattern, with the
+    case sensitivity of the file system (like glob)."""
+    try:
+        return _patterns[pattern]
+    except KeyError:
+        regex = re.compile(fnmatch.translate(os.path.normcase(pattern)))
+        if os.path.normcase("A") == "A":
+            match = regex.match
+        else:
+            match = lambda name: regex.match(os.path.normcase(name))
+        _patterns[pattern] = match
+        return match
+
+
+def list_dir(path, pattern="*"):
+    """Return the names in path matching pattern. Nothing is stat'ed, so the
+    names may include directories."""
+    match = compile_pattern(pattern)
+    return [name for name in os.listdir(path) if match(name)]
+
+
+def stat_file(path):
+    """Return (size, mtime) of the file at path or None if it is missing or
+    a directory."""
+    try:
+        result = os.stat(path)
+    except OSError:
+        return None
+    if stat.S_ISDIR(result.st_mode):
+        return None
+    return result.st_size, result.st_mtime
+
+
+def stat_dir(path):
+    """Yield (name, size, mtime) of all files (not directories) in path."""
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                if entry.is_file():
+                    stat = entry.stat()
+                    yield entry.name, stat.st_size, stat.st_mtime
+            except OSError:
+                # removed while scanning
+                pass
+    else:
+        for name in os.listdir(path):
+            result = stat_file(os.path.join(path, name))
+            if result is not None:
+                yield (name,) + result
+
+
+class FileCache(object):
+    """Metadata of the files in a directory, refreshed with one scan per
+    tick. A file is settled once its size and mtime have not changed for
+    settle seconds, as observed by the scans."""
+    def __init__(self, path, settle=5):
+        self.path = path
+        self.settle = settle
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Scan the directory and update the entries."""
+        now = time.time()
+        entries = {}
+        for name, size, mtime in stat_dir(self.path):
+            old = self.entries.get(name)
+            if old is None:
+                entries[name] = Entry(size, mtime, now, now, 0)
+            elif old.size != size or old.mtime != mtime:
+                entries[name] = Entry(size, mtime, old.first_seen, now, 0)
+            else:
+                entries[name] = old._replace(checks=old.checks + 1)
+        with self.lock:
+            self.entries = entries
+
+    def names(self, pattern="*"):
+        """Return the names of the files found by the last scan matching
+        pattern."""
+        match = compile_pattern(pattern)
+        return [name for name in list(self.entries) if match(name)]
+
+    def settled(self, name):
+        """Return True if the file has stopped changing."""
+        entry = self.entries.get(name)
+        return (entry is not None and entry.checks > 0 and
+                time.time() - entry.changed >= self.settle)
+
+    def unchanged_for(self, name):
+        """Return the seconds since the file was last seen changing."""
+        entry = self.entries.get(name)
+        return 0 if entry is None else time.time() - entry.changed
+
+    def rename(self, old_name, new_name):
+        """Move the entry of a file renamed by this process."""
+        with self.lock:
+            entry = self.entries.pop(old_name, None)
+            if entry is not None:
+                self.entries[new_name] = entry
@@ -0,0 +1,463 @@
+"""Transport backends used by autocopy to copy files to and list the remote
+folder. All backends provide copy(src, name), send(src, name, codec),
+resume(src, name, chunk), bundle(files), listdir(), iter_listing(since) and
+count_files()."""
+import os, time, shutil, posixpath, threading, logging, tarfile, tempfile, io
+import zlib, lzma, hashlib
+import scan
+from subprocess import Popen, PIPE, DEVNULL, TimeoutExpired
+
+CHUNK = 1 << 20  # bytes read at once when compressing
+# suffix of the partial files of resumed transfers, which are not listed
+PARTIAL = ".part"
+
+# compressor factory, remote decompression command and local decompression
+# function of each codec
+CODECS = {"zlib": (lambda: zlib.compressobj(6, zlib.DEFLATED, 31),
+                   "gzip -dc", lambda data: zlib.decompress(data, 47)),
+          "lzma": (lambda: lzma.LZMACompressor(preset=1), "xz -dc",
+                   lzma.decompress)}
+try:
+    import zstandard
+    CODECS["zstd"] = (lambda: zstandard.ZstdCompressor().compressobj(),
+                      "zstd -dc",
+                      lambda data: zstandard.ZstdDecompressor()
+                      .decompressobj().decompress(data))
+except ImportError:
+    pass
+# tarfile stream suffix and tar option of the codecs usable for bundles
+TAR_MODES = {"zlib": ("gz", "z"), "lzma": ("xz", "J")}
+# prints the md5sum of every chunk of a file, the last one may be shorter.
+# Scripts are sent to "sh -s" on stdin, so that the local shell (cmd.exe for
+# PuTTY) never sees their quotes, pipes and redirections
+CHUNK_SCRIPT = ('f=\'%s\'; [ -f "$f" ] || exit 0; s=$(stat -c %%s "$f"); '
+                'i=0; while [ $((i * %d)) -lt $s ]; do dd if="$f" bs=%d '
+                'skip=$i count=1 2>/dev/null | md5sum; i=$((i + 1)); done')
+# renames the partial file if the md5sum of its chunk digests is checksum
+VERIFY_SCRIPT = ('[ "$(%s | md5sum)" = \'%s  -\' ] && mv \'%s\' \'%s\'')
+# size, mtime and chunk digests of the files being resumed by path, the
+# digests are computed while the chunks are sent
+_digests = {}
+
+
+class TransportError(Exception):
+    """Raised when the remote location can not be accessed."""
+
+
+def _decode(data):
+    return data.decode("ascii", "replace").strip()
+
+
+def write_tar(fileobj, files, codec=None):
+    """Write a tar stream of files, given as (src, name) tuples, to fileobj,
+    compressed with codec if it is one of TAR_MODES."""
+    mode = "w|" + TAR_MODES[codec][0] if codec in TAR_MODES else "w|"
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        for src, name in files:
+            tar.add(src, arcname=name)
+
+
+def compress_file(fileobj, src, codec):
+    """Write file src compressed with codec to fileobj. Return the size of
+    the file, the compressed size and the CPU time spent compressing."""
+    clock = getattr(time, "thread_time", time.process_time)
+    start = clock()
+    compressor = CODECS[codec][0]()
+    size = packed = 0
+    with open(src, "rb") as file_:
+        for chunk in iter(lambda: file_.read(CHUNK), b""):
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            packed += len(data)
+            fileobj.write(data)
+    data = compressor.flush()
+    packed += len(data)
+    fileobj.write(data)
+    return size, packed, clock() - start
+
+
+def chunk_digests(file_, chunk, start=0, stop=None):
+    """Return the md5 hex digests of the chunks of the open file_ from chunk
+    number start up to stop."""
+    digests = []
+    file_.seek(start * chunk)
+    while stop is None or start + len(digests) < stop:
+        data = file_.read(chunk)
+        if not data:
+            break
+        digests.append(hashlib.md5(data).hexdigest())
+    return digests
+
+
+def listing_checksum(digests):
+    """Return the checksum of a whole file from the digests of its chunks:
+    the md5 of their listing as printed by md5sum and CHUNK_SCRIPT."""
+    return hashlib.md5("".join(digest + "  -\n" for digest in digests)
+                       .encode("ascii")).hexdigest()
+
+
+def resume_offset(src, chunk, remote):
+    """Compare the chunk digests of the partial copy on the remote with the
+    ones of src. Return the offset of the first chunk to send and the list
+    of digests of the verified chunks before it, which :py:func:`feed_chunks`
+    extends. Chunks whose digests are not known from an earlier attempt are
+    read again."""
+    stat = os.stat(src)
+    size, mtime, known = _digests.get(src, (None, None, []))
+    if (size, mtime) != (stat.st_size, stat.st_mtime):
+        known = []
+    if len(known) < len(remote):
+        with open(src, "rb") as file_:
+            known = known + chunk_digests(file_, chunk, len(known),
+                                          len(remote))
+    verified = 0
+    while verified < len(remote) and verified < len(known) and \
+            remote[verified] == known[verified]:
+        verified += 1
+    digests = known[:verified]
+    _digests[src] = (stat.st_size, stat.st_mtime, digests)
+    return min(verified * chunk, stat.st_size), digests
+
+
+def feed_chunks(fileobj, src, chunk, offset, digests):
+    """Write src from offset to fileobj chunk by chunk, appending the digest
+    of every chunk to digests while it is read. Return the bytes written."""
+    sent = 0
+    with open(src, "rb") as file_:
+        file_.seek(offset)
+        for data in iter(lambda: file_.read(chunk), b""):
+            digests.append(hashlib.md5(data).hexdigest())
+            fileobj.write(data)
+            sent += len(data)
+    return sent
+
+
+class PuttyTransport:
+    """Start a pscp process for every file and a plink process for listing,
+    each one performing its own SSH handshake."""
+    shell = True
+
+    def __init__(self, host, folder, pscp="pscp", plink="plink"):
+        self.host = host
+        self.folder = folder
+        self.pscp = pscp
+        self.plink = plink
+
+    def options(self):
+        """Return extra command line options passed to pscp and plink."""
+        return []
+
+    def run(self, args, timeout=None, input=None):
+        """Run a command, writing input (bytes) to its stdin, and return the
+        exit code, output and error output. The command is killed if it runs
+        for more than timeout seconds."""
+        proc = Popen(args, shell=self.shell, stdout=PIPE, stderr=PIPE,
+                     stdin=None if input is None else PIPE)
+        try:
+            out, err = proc.communicate(input, timeout=timeout)
+        except TimeoutExpired:
+            proc.kill()
+            out, err = proc.communicate()
+            err = ("Timed out after %g s. " % timeout).encode("ascii") + err
+        return proc.returncode, out, err
+
+    def remote(self, *command):
+        """Return the arguments running command on the remote host."""
+        return [self.plink, "-ssh"] + self.options() + [self.host] + \
+            list(command)
+
+    def copy(self, src, name, timeout=None):
+        """Copy local file src to name in the remote folder.
+        Return the exit code and the error output."""
+        dest = posixpath.join("%s:." % self.host, self.folder, name)
+        code, out, err = self.run([self.pscp] + self.options() + [src, dest],
+                                  timeout)
+        return code, _decode(err)
+
+    def pipe(self, args, write, timeout=None):
+        """Run a command while write(stdin) feeds it from a separate thread.
+        Return the exit code, the output and the result of write."""
+        result = [None]
+        # output goes to a file, so a chatty remote can't block the stream
+        with tempfile.TemporaryFile() as output:
+            proc = Popen(args, shell=self.shell, stdin=PIPE, stdout=output,
+                         stderr=output)
+
+            def feed():
+                try:
+                    result[0] = write(proc.stdin)
+                except (IOError, OSError) as e:
+                    output.write(str(e).encode("ascii", "replace"))
+                finally:
+                    try:
+                        proc.stdin.close()
+                    except (IOError, OSError):
+                        pass
+
+            feeder = threading.Thread(target=feed, daemon=True)
+            feeder.start()
+            try:
+                proc.wait(timeout)
+            except TimeoutExpired:
+                proc.kill()
+                proc.wait()
+                output.write(("Timed out after %g s. " % timeout)
+                             .encode("ascii"))
+            feeder.join()
+            output.seek(0)
+            return proc.returncode, _decode(output.read()), result[0]
+
+    def send(self, src, name, codec, timeout=None):
+        """Copy local file src to name in the remote folder, compressed with
+        codec while it is sent and decompressed on the remote. Return the exit
+        code, the error output and the statistics of :py:func:`compress_file`.
+        """
+        dest = posixpath.join(self.folder, name)
+        args = self.remote("%s > '%s'" % (CODECS[codec][1], dest))
+        return self.pipe(args, lambda fileobj: compress_file(fileobj, src,
+                                                             codec), timeout)
+
+    def resume(self, src, name, chunk, timeout=None):
+        """Copy local file src to name in the remote folder through a partial
+        file, continuing after the chunks which already arrived intact. The
+        whole file is verified on the remote before the partial file is
+        renamed. Return the exit code, the error output and the checksum of
+        :py:func:`listing_checksum`."""
+        part = posixpath.join(self.folder, name + PARTIAL)
+        listing = CHUNK_SCRIPT % (part, chunk, chunk)
+        code, out, err = self.run(self.remote("sh -s"), timeout,
+                                  listing.encode("utf-8"))
+        if code != 0:
+            return code, _decode(err), None
+        remote = [line.split()[0] for line in _decode(out).splitlines()]
+        offset, digests = resume_offset(src, chunk, remote)
+        if offset:
+            logging.getLogger("autocopy.transport").info(
+                "Resuming '%s' at %d bytes", name, offset)
+        command = "truncate -s %d '%s' && cat >> '%s'" % (offset, part, part)
+        code, err, _ = self.pipe(self.remote(command),
+                                 lambda fileobj: feed_chunks(
+                                     fileobj, src, chunk, offset, digests),
+                                 timeout)
+        if code != 0:
+            return code, err, None
+        checksum = listing_checksum(digests)
+        script = VERIFY_SCRIPT % (listing, checksum, part,
+                                  posixpath.join(self.folder, name))
+        code, out, err = self.run(self.remote("sh -s"), timeout,
+                                  script.encode("utf-8"))
+        if code != 0:
+            return code, "Checksum mismatch. " + _decode(err), None
+        _digests.pop(src, None)
+        return 0, "", checksum
+
+    def bundle(self, files, timeout=None, codec=None):
+        """Stream files, given as (src, name) tuples, as one tar archive which
+        is unpacked in the remote folder. Return the exit code and the error
+        output."""
+        option = TAR_MODES[codec][1] if codec in TAR_MODES else ""
+        args = self.remote("tar -x%sf - -C '%s'" % (option, self.folder))
+        code, err, _ = self.pipe(args, lambda fileobj: write_tar(fileobj,
+                                                                 files, codec),
+                                 timeout)
+        return code, err
+
+    def listdir(self):
+        """Return a list of the names in the remote folder."""
+        code, out, err = self.run(self.remote("ls", self.folder))
+        if code != 0:
+            raise TransportError(_decode(err) if len(err) else _decode(out))
+        return [line.strip() for line in _decode(out).splitlines()]
+
+    def iter_listing(self, since=None):
+        """Yield (mtime, name) of the files in the remote folder modified
+        after since (epoch) or all files, parsing the listing line by line as
+        it arrives. Partial files are left out. Needs GNU find on the
+        remote."""
+        command = "find '%s' -maxdepth 1 -type f -not -name '*%s'" % (
+            self.folder, PARTIAL)
+        if since is not None:
+            command += " -newermt '@%d'" % since
+        command += " -printf '%T@ %f\\n'"
+        with tempfile.TemporaryFile() as errors:
+            proc = Popen(self.remote(command), shell=self.shell, stdout=PIPE,
+                         stderr=errors)
+            for line in proc.stdout:
+                mtime, _, name = line.decode("utf-8", "replace") \
+                    .rstrip("\r\n").partition(" ")
+                yield float(mtime), name
+            if proc.wait() != 0:
+                errors.seek(0)
+                raise TransportError(_decode(errors.read()))
+
+    def count_files(self):
+        """Return the number of files in the remote folder, partial files
+        left out."""
+        code, out, err = self.run(self.remote(
+            "find '%s' -maxdepth 1 -type f -not -name '*%s' | wc -l" %
+            (self.folder, PARTIAL)))
+        if code != 0:
+            raise TransportError(_decode(err) if len(err) else _decode(out))
+        return int(_decode(out))
+
+    def close(self):
+        pass
+
+
+class SharedPuttyTransport(PuttyTransport):
+    """Keep one authenticated plink connection open and let pscp and plink
+    open their channels on it through PuTTY connection sharing. The upstream
+    connection is restarted whenever it has died."""
+    def __init__(self, *args, **kwargs):
+        PuttyTransport.__init__(self, *args, **kwargs)
+        self.upstream = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Start the upstream connection if it is not running."""
+        with self.lock:
+            if self.upstream is None or self.upstream.poll() is not None:
+                if self.upstream is not None:
+                    logging.getLogger("autocopy.transport").warning(
+                        "Shared connection to '%s' died, reconnecting.",
+                        self.host)
+                self.upstream = Popen([self.plink, "-ssh", "-share", "-N",
+                                       self.host], shell=True,
+                                      stdin=PIPE, stdout=DEVNULL,
+                                      stderr=DEVNULL)
+
+    def options(self):
+        self.connect()
+        return ["-share"]
+
+    def close(self):
+        if self.upstream is not None and self.upstream.poll() is None:
+            self.upstream.terminate()
+            self.upstream.wait()
+
+
+class OpenSSHTransport(PuttyTransport):
+    """Use scp and ssh with a multiplexed master connection, which is
+    established on first use and kept open for persist seconds."""
+    def __init__(self, host, folder, scp="scp", ssh="ssh", persist=600,
+                 control_path=os.path.join("~", ".ssh", "autocopy-%C")):
+        PuttyTransport.__init__(self, host, folder)
+        self.scp = scp
+        self.ssh = ssh
+        self.persist = persist
+        self.control_path = os.path.expanduser(control_path)
+
+    def options(self):
+        return ["-o", "ControlMaster=auto",
+                "-o", "ControlPath=%s" % self.control_path,
+                "-o", "ControlPersist=%d" % self.persist,
+                "-o", "BatchMode=yes"]
+
+    shell = False
+
+    def remote(self, *command):
+        return [self.ssh] + self.options() + [self.host] + list(command)
+
+    def copy(self, src, name, timeout=None):
+        dest = "%s:%s" % (self.host, posixpath.join(self.folder, name))
+        code, out, err = self.run([self.scp, "-q"] + self.options() +
+                                  [src, dest], timeout)
+        return code, _decode(err)
+
+    def close(self):
+        self.run([self.ssh] + self.options() + ["-O", "exit", self.host])
+
+
+class LocalTransport:
+    """Copy files to a local folder, used as a stand-in for the remote."""
+    def __init__(self, host, folder):
+        self.folder = folder
+
+    def copy(self, src, name, timeout=None):
+        try:
+            shutil.copyfile(src, os.path.join(self.folder, name))
+        except (IOError, OSError) as e:
+            return 1, str(e)
+        return 0, ""
+
+    def send(self, src, name, codec, timeout=None):
+        stream = io.BytesIO()
+        try:
+            stats = compress_file(stream, src, codec)
+            with open(os.path.join(self.folder, name), "wb") as file_:
+                file_.write(CODECS[codec][2](stream.getvalue()))
+        except (IOError, OSError, zlib.error, lzma.LZMAError) as e:
+            return 1, str(e), None
+        return 0, "", stats
+
+    def resume(self, src, name, chunk, timeout=None):
+        part = os.path.join(self.folder, name + PARTIAL)
+        try:
+            try:
+                with open(part, "rb") as file_:
+                    remote = chunk_digests(file_, chunk)
+            except FileNotFoundError:
+                remote = []
+            offset, digests = resume_offset(src, chunk, remote)
+            with open(part, "ab") as file_:
+                file_.truncate(offset)
+                feed_chunks(file_, src, chunk, offset, digests)
+            with open(part, "rb") as file_:
+                if chunk_digests(file_, chunk) != digests:
+                    return 1, "Checksum mismatch.", None
+            os.replace(part, os.path.join(self.folder, name))
+        except (IOError, OSError) as e:
+            return 1, str(e), None
+        _digests.pop(src, None)
+        return 0, "", listing_checksum(digests)
+
+    def bundle(self, files, timeout=None, codec=None):
+        stream = io.BytesIO()
+        try:
+            write_tar(stream, files, codec)
+            stream.seek(0)
+            with tarfile.open(fileobj=stream, mode="r|*") as tar:
+                tar.extractall(self.folder)
+        except (IOError, OSError, tarfile.TarError) as e:
+            return 1, str(e)
+        return 0, ""
+
+    def listdir(self):
+        try:
+            return os.listdir(self.folder)
+        except OSError as e:
+            raise TransportError(str(e))
+
+    def iter_listing(self, since=None):
+        try:
+            for name, size, mtime in scan.stat_dir(self.folder):
+                if not name.endswith(PARTIAL) and \
+                        (since is None or mtime > since):
+                    yield mtime, name
+        except OSError as e:
+            raise TransportError(str(e))
+
+    def count_files(self):
+        try:
+            return sum(1 for name, _, _ in scan.stat_dir(self.folder)
+                       if not name.endswith(PARTIAL))
+        except OSError as e:
+            raise TransportError(str(e))
+
+    def close(self):
+        pass
+
+
+BACKENDS = {"putty": PuttyTransport,
+            "putty-shared": SharedPuttyTransport,
+            "openssh": OpenSSHTransport,
+            "local": LocalTransport}
+
+
+def make_transport(backend, host, folder):
+    """Return the transport called backend for the remote folder on host."""
+    try:
+        return BACKENDS[backend](host, folder)
+    except KeyError:
+        raise ValueError("Unknown transport '%s', choose from: %s" %
+                         (backend, ", ".join(sorted(BACKENDS))))
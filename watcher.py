@@ -0,0 +1,85 @@
+"""Module providing change notifications for the data folder, so that new
+files can be transferred as soon as they are written instead of on the next
+poll. Only inotify (Linux) is supported, on other systems make_watcher
+returns None and autocopy keeps polling."""
+import os, sys, time, select, struct, fnmatch, logging, ctypes, ctypes.util
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """Report files in a directory which were closed after writing or moved
+    into it."""
+    def __init__(self, path, pattern, reconcile=60):
+        self.path = path
+        self.pattern = pattern
+        # seconds between full scans catching events that were missed
+        self.reconcile = reconcile
+        self.last_reconcile = time.time()
+        self.overflow = False
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed", path)
+
+    def close(self):
+        os.close(self.fd)
+
+    def reconcile_due(self):
+        """Return True if a full scan of the directory should be done."""
+        now = time.time()
+        if self.overflow or now - self.last_reconcile > self.reconcile:
+            self.overflow = False
+            self.last_reconcile = now
+            return True
+        return False
+
+    def _read(self):
+        """Return the names of the files of all pending events."""
+        names = set()
+        buf = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(buf):
+            _, mask, _, length = EVENT.unpack_from(buf, offset)
+            offset += EVENT.size
+            name = buf[offset:offset+length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                self.overflow = True
+            elif name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def wait(self, timeout, settle=0.1):
+        """Block for at most timeout seconds until files are closed and return
+        the set of their names matching the pattern. Events following within
+        settle seconds (e.g. all channels of a shot) are returned together."""
+        names = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while ready:
+            names.update(self._read())
+            ready, _, _ = select.select([self.fd], [], [], settle)
+        return set(name for name in names
+                   if fnmatch.fnmatch(name, self.pattern))
+
+
+def make_watcher(path, pattern, reconcile=60):
+    """Return a watcher for path or None if notifications are unavailable."""
+    logger = logging.getLogger("autocopy.watcher")
+    if not sys.platform.startswith("linux"):
+        logger.info("No change notifications on %s, polling.", sys.platform)
+        return None
+    try:
+        return InotifyWatcher(path, pattern, reconcile)
+    except (OSError, AttributeError) as e:
+        logger.error("Could not watch '%s', polling:\n%s:%s",
+                     path, type(e), e)
+        return None